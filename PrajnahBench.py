@@ -0,0 +1,388 @@
+'''
+MIT License
+
+Copyright (c) 2021 Rajnish Mishra
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+'''
+
+import tweepy as tw
+from tweepy.parsers import ModelParser
+import json, logging, threading
+from time import sleep, time, perf_counter
+from argparse import ArgumentParser
+
+API_URL = 'https://api.twitter.com/1.1/{0}.json'
+
+# Rate limits of the endpoints (calls, window in seconds) as on Twitter
+RATE_LIMITS = {
+    'account/verify_credentials': (75, 900),
+    'statuses/mentions_timeline': (75, 900),
+    'statuses/show': (900, 900),
+    'statuses/lookup': (900, 900),
+    'statuses/update': (300, 10800)
+}
+
+class MockUser:
+    def __init__(self, id, screen_name, name=None):
+        self.id = id
+        self.screen_name = screen_name
+        self.name = name or screen_name
+
+class MockStatus:
+    ''' Just enough of a tweepy Status for the bot '''
+    def __init__(self, id, user: MockUser, text: str, mentions=[], in_reply_to=None):
+        self.id = id
+        self.user = user
+        self.full_text = text
+        self.in_reply_to_status_id = in_reply_to.id if in_reply_to else None
+        self.in_reply_to_screen_name = in_reply_to.user.screen_name if in_reply_to else None
+        self.entities = {'user_mentions': []}
+        for name in mentions:
+            start = text.find('@' + name)
+            self.entities['user_mentions'].append({'screen_name': name, 'indices': [start, start + len(name) + 1]})
+
+    def view(self, extended, truncate):
+        ''' Gives a copy as the API would send it, compat mode texts are cut at the given length '''
+        status = MockStatus.__new__(MockStatus)
+        status.__dict__.update(self.__dict__)
+        if extended :
+            return status
+        del status.full_text
+        status.truncated = len(self.full_text) > truncate
+        status.text = "{0}…".format(self.full_text[:truncate-1]) if status.truncated else self.full_text
+        return status
+
+    def json(self, truncate):
+        ''' Gives the tweet as in the tweet_create_events of the account activity webhooks '''
+        view = self.view(False, truncate)
+        data = {'id': self.id, 'id_str': str(self.id), 'text': view.text, 'truncated': view.truncated, 'entities': self.entities,
+            'user': {'id': self.user.id, 'id_str': str(self.user.id), 'screen_name': self.user.screen_name, 'name': self.user.name},
+            'in_reply_to_status_id': self.in_reply_to_status_id, 'in_reply_to_screen_name': self.in_reply_to_screen_name}
+        if view.truncated :
+            data['extended_tweet'] = {'full_text': self.full_text, 'entities': self.entities}
+        return data
+
+class MockResponse:
+    def __init__(self, endpoint, headers):
+        self.url = API_URL.format(endpoint)
+        self.headers = headers
+
+class MockAPI:
+    '''
+        Offline stand-in for the endpoints of the twitter API used by the bot, with configurable
+        latency, truncation and rate limits (reported with the usual headers)
+    '''
+    def __init__(self, username='PrajnahBot', latency=0.0, truncate=140, ratelimits=False, window_scale=1.0):
+        import random
+        self.random = random.Random(0)
+        self.latency = latency
+        self.truncate = truncate
+        self.ratelimits = ratelimits
+        self.window_scale = window_scale
+        self.lock = threading.Lock()
+        self.bot = MockUser(1, username)
+        self.statuses = {}
+        self.mentions = []
+        self.replies = []
+        self.posted = {}
+        self.calls = dict((x, 0) for x in RATE_LIMITS)
+        self.budgets = {}
+        self.last_response = None
+        self.parser = ModelParser()
+        self.next_id = 1000
+
+    def __call__(self, endpoint):
+        ''' Accounts a call to the endpoint, with latency and rate limits '''
+        if self.latency > 0 :
+            sleep(self.latency * (0.5 + self.random.random()))
+        with self.lock:
+            self.calls[endpoint] += 1
+            limit, window = RATE_LIMITS[endpoint]
+            window *= self.window_scale
+            remaining, reset = self.budgets.get(endpoint, (limit, time() + window))
+            if reset <= time():
+                remaining, reset = limit, time() + window
+            headers = {'x-rate-limit-limit': str(limit), 'x-rate-limit-remaining': str(max(remaining - 1, 0)), 'x-rate-limit-reset': str(int(reset) + 1)}
+            self.last_response = MockResponse(endpoint, headers)
+            if self.ratelimits and remaining <= 0 :
+                raise tw.RateLimitError([{'message': 'Rate limit exceeded', 'code': 88}], self.last_response)
+            self.budgets[endpoint] = (max(remaining - 1, 0), reset)
+
+    def __new_id__(self):
+        with self.lock:
+            self.next_id += 1
+            return self.next_id
+
+    def post_mention(self, text: str, screen_name='user', in_reply_to=None):
+        ''' Posts a tweet mentioning the bot, as a user would '''
+        user = MockUser(hash(screen_name) % 10**9, screen_name)
+        parent = self.statuses.get(in_reply_to, None)
+        status = MockStatus(self.__new_id__(), user, "@{0} {1}".format(self.bot.screen_name, text), [self.bot.screen_name], parent)
+        with self.lock:
+            self.statuses[status.id] = status
+            self.mentions.append(status)
+            self.posted[status.id] = perf_counter()
+        return status
+
+    def me(self):
+        self('account/verify_credentials')
+        return self.bot
+
+    def mentions_timeline(self, count=20, since_id=None, max_id=None, tweet_mode=None, **kwargs):
+        self('statuses/mentions_timeline')
+        with self.lock:
+            found = [x for x in reversed(self.mentions) if (since_id is None or x.id > since_id) and (max_id is None or x.id <= max_id)]
+        return [x.view(tweet_mode == 'extended', self.truncate) for x in found[:min(count, 200)]]
+
+    def get_status(self, id, tweet_mode=None, **kwargs):
+        self('statuses/show')
+        if id not in self.statuses :
+            raise tw.TweepError([{'message': 'No status found with that ID.', 'code': 144}])
+        return self.statuses[id].view(tweet_mode == 'extended', self.truncate)
+
+    def statuses_lookup(self, id_, tweet_mode=None, **kwargs):
+        self('statuses/lookup')
+        return [self.statuses[x].view(tweet_mode == 'extended', self.truncate) for x in id_[:100] if x in self.statuses]
+
+    def update_status(self, status, in_reply_to_status_id=None, tweet_mode=None, **kwargs):
+        self('statuses/update')
+        parent = self.statuses.get(in_reply_to_status_id, None)
+        text = "@{0} {1}".format(parent.user.screen_name, status) if parent else status
+        tweet = MockStatus(self.__new_id__(), self.bot, text, [parent.user.screen_name] if parent else [], parent)
+        with self.lock:
+            self.statuses[tweet.id] = tweet
+            self.replies.append((in_reply_to_status_id, perf_counter(), threading.current_thread().name))
+        return tweet.view(tweet_mode == 'extended', self.truncate)
+
+def synthetic_mentions(paths, count, calc_ratio=0.0):
+    ''' Gives mention texts out of the corpus files, with a share of !calc expressions '''
+    import random, yaml
+    rand = random.Random(0)
+    texts = []
+    for path in paths:
+        with open(path, 'r') as corpus_file:
+            corpus = yaml.safe_load(corpus_file)
+        texts += [x[0] for x in corpus.get('conversations', []) if len(x) > 0]
+    if len(texts) == 0 :
+        texts = ['Hello']
+    mentions = []
+    for _ in range(count):
+        if rand.random() < calc_ratio :
+            mentions.append({'text': "!calc {0}*{1}+{2}".format(rand.randint(1, 999), rand.randint(1, 999), rand.randint(1, 999))})
+        else:
+            mentions.append({'text': rand.choice(texts)})
+    return mentions
+
+def recorded_mentions(path, count=None):
+    ''' Gives the mentions recorded in a jsonl file, one {"text", "user", "delay"} per line '''
+    mentions = []
+    with open(path, 'r') as jsonl:
+        for line in jsonl:
+            if line.strip():
+                mentions.append(json.loads(line))
+    return mentions[:count] if count else mentions
+
+def percentile(values, p):
+    if len(values) == 0 :
+        return 0.0
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def send_event(url: str, secret: bytes, event: dict):
+    ''' Sends a signed account activity event to a webhook receiver, as twitter would '''
+    from urllib.request import Request, urlopen
+    from TwitterPrajnah import WebhookReceiver
+    payload = json.dumps(event).encode()
+    request = Request(url, payload, {'Content-Type': 'application/json', 'x-twitter-webhooks-signature': WebhookReceiver.sign(secret, payload)})
+    with urlopen(request) as response:
+        return response.status
+
+def bench_db(config, mod_dir, corpus, count, threads):
+    ''' Times the lookups AITalk makes in its database (read-only), with the storage settings of the config '''
+    from concurrent.futures import ThreadPoolExecutor
+    from chatterbot.storage import SQLStorageAdapter
+    from PrajnahTrainer import get_database_uri
+    from TwitterPrajnah import find_modules
+    aitalk = find_modules(mod_dir, ['aitalk'])[0]
+    aitalk_config = getattr(config, 'aitalk', None)
+    storage = aitalk.Storage(aitalk_config, get_database_uri(aitalk_config), logging.getLogger('bench'))
+    began = perf_counter()
+    adapter = storage.attach(SQLStorageAdapter(database_uri=storage.uri))
+    print("Storage ready (with the indexes checked) in {0:.2f}s, {1} statements".format(perf_counter() - began, adapter.count()))
+
+    # The same lookups as responding does: the closest statements by search text, their responses, and statements by text (learning)
+    texts = [x['text'] for x in synthetic_mentions(corpus, count)]
+    lookups = [(text, adapter.tagger.get_text_index_string(text)) for text in texts]
+    queries = {
+        'search_text': lambda text, search_text: adapter.filter(search_text_contains=search_text, persona_not_startswith='bot:'),
+        'search_in_response_to': lambda text, search_text: adapter.filter(search_in_response_to=search_text, persona_not_startswith='bot:'),
+        'text': lambda text, search_text: adapter.filter(text=text)
+    }
+    def timed(query, lookup):
+        began = perf_counter()
+        rows = sum(1 for _ in query(*lookup))
+        return perf_counter() - began, rows
+
+    print("\n{0:<24} {1:>8} {2:>10} {3:>10} {4:>10} {5:>10} {6:>12}".format('lookup', 'count', 'rows', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)', 'lookups/s'))
+    with ThreadPoolExecutor(threads) as executor:
+        for name, query in queries.items():
+            began = perf_counter()
+            results = list(executor.map(lambda x: timed(query, x), lookups))
+            elapsed = perf_counter() - began
+            times = [x for x, _ in results]
+            print("{0:<24} {1:>8} {2:>10.1f} {3:>10.2f} {4:>10.2f} {5:>10.2f} {6:>12.1f}".format(name, len(results),
+                sum(x for _, x in results) / max(len(results), 1), percentile(times, 50)*1000, percentile(times, 95)*1000,
+                percentile(times, 99)*1000, len(results) / elapsed))
+    for engine, db in storage.engines(adapter):
+        print("\n{0}: {1}".format(db, engine.pool.status()))
+
+def main():
+    from TwitterPrajnah import Config, Supervisor, find_modules
+    import os, sys, asyncio
+
+    parser = ArgumentParser(description="Benchmarks the bot against an offline mock of the twitter API")
+    parser.add_argument('-c', '--config', help="Config file (default: none, all defaults)", dest='config', nargs=1, type=str)
+    parser.add_argument('-m', '--mods-dir', help="Modules directory (default: ./mods)", dest='mod_dir', type=str, \
+        default=os.path.dirname(os.path.realpath(sys.argv[0])) + os.sep + 'mods')
+    parser.add_argument('-M', '--modules', help="Modules to load (default: calc)", dest='modules', nargs='+', type=str, default=['calc'])
+    parser.add_argument('-r', '--replay', help="Replay the mentions recorded in a jsonl file", dest='replay', type=str)
+    parser.add_argument('-f', '--corpus', help="Corpus files for synthetic mentions (default: corpus/example.yml)", dest='corpus', nargs='+', type=str, default=['corpus/example.yml'])
+    parser.add_argument('-n', '--count', help="Number of mentions (default: 200)", dest='count', type=int, default=200)
+    parser.add_argument('--calc-ratio', help="Share of !calc mentions among the synthetic ones (default: 0.5)", dest='calc_ratio', type=float, default=0.5)
+    parser.add_argument('--rate', help="Mentions posted per second, 0 to post all at once (default: 0)", dest='rate', type=float, default=0)
+    parser.add_argument('--latency', help="Mean latency of an API call in ms (default: 50)", dest='latency', type=float, default=50)
+    parser.add_argument('--truncate', help="Length at which texts are truncated in compat mode (default: 140)", dest='truncate', type=int, default=140)
+    parser.add_argument('--ratelimits', help="Enforce the rate limits", action='store_true', dest='ratelimits')
+    parser.add_argument('--window-scale', help="Scale of the rate limit windows (default: 1)", dest='window_scale', type=float, default=1.0)
+    parser.add_argument('--poll', help="Seconds between polls (default: 0.5)", dest='poll', type=float, default=0.5)
+    parser.add_argument('--webhook', help="Also send each mention to the bot as a signed webhook event", action='store_true', dest='webhook')
+    parser.add_argument('--delay', help="Seconds between replies, overriding request_delay (default: from config)", dest='delay', type=float)
+    parser.add_argument('--db', help="Benchmark the database lookups of aitalk instead, with the storage settings of the config", action='store_true', dest='db')
+    parser.add_argument('--threads', help="Threads doing the lookups with --db (default: 4)", dest='threads', type=int, default=4)
+    parser.add_argument('--timeout', help="Seconds to wait for all the replies (default: 120)", dest='timeout', type=float, default=120)
+    parser.add_argument('-d', '--debug', help="Enable debug", action='store_true', dest='debug')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(name)-12s - %(message)s', level=(logging.DEBUG if args.debug else logging.WARNING))
+    config = Config(args.config[0]) if args.config else Config.__new__(Config)
+    if not args.config :
+        config._json = {}
+    if args.db :
+        bench_db(config, args.mod_dir, args.corpus, args.count, args.threads)
+        exit(0)
+
+    mentions = recorded_mentions(args.replay, args.count) if args.replay else synthetic_mentions(args.corpus, args.count, args.calc_ratio)
+    api = MockAPI(latency=args.latency/1000, truncate=args.truncate, ratelimits=args.ratelimits, window_scale=args.window_scale)
+    modules = find_modules(args.mod_dir, args.modules)
+
+    # The module handlers are timed, with the thread names telling which module sent a reply
+    handled, done, routed = {}, {}, {}
+    def timed(mod):
+        handler = mod.onTweetReceived
+        def finished(tweet, began):
+            handled.setdefault(mod.__modname__, []).append(perf_counter() - began)
+            done[tweet.id] = done.get(tweet.id, 0) + 1
+        if asyncio.iscoroutinefunction(handler) :
+            async def onTweetReceived(bot, config, logger, tweet):
+                began = perf_counter()
+                try:
+                    await handler(bot, config, logger, tweet)
+                finally:
+                    finished(tweet, began)
+            return onTweetReceived
+        def onTweetReceived(bot, config, logger, tweet):
+            thread = threading.current_thread()
+            name, thread.name = thread.name, "bench:{0}".format(mod.__modname__)
+            began = perf_counter()
+            try:
+                handler(bot, config, logger, tweet)
+            finally:
+                finished(tweet, began)
+                thread.name = name
+        return onTweetReceived
+    for mod in modules:
+        if hasattr(mod, 'onTweetReceived'):
+            mod.onTweetReceived = timed(mod)
+
+    # Webhook events go to the receiver on a free local port
+    if args.webhook :
+        config.webhook = dict(getattr(config, 'webhook', None) or {}, host='127.0.0.1', port=0, secret='bench')
+
+    # The bot runs as it does for real, only on the mock
+    supervisor = Supervisor(config, modules, api=api)
+    route = supervisor.router.route
+    def routing(bot, tweet):
+        routed[tweet.id] = route(bot, tweet)
+        return routed[tweet.id]
+    supervisor.router.route = routing
+    # The polling starts right after the first mention
+    first = api.post_mention('Hello', 'bench')
+    for bot in supervisor.bots:
+        bot.last_statusid = first.id
+        bot.sleep_time = args.poll
+        if args.delay is not None :
+            bot.request_delay = args.delay
+
+    # Calls made loading the modules aside
+    supervisor.start()
+    calls_before = dict(api.calls)
+    if supervisor.webhook :
+        url = "http://127.0.0.1:{0}{1}".format(supervisor.webhook.server.server_port, supervisor.webhook.path)
+    began = perf_counter()
+    for mention in mentions:
+        status = api.post_mention(mention['text'], mention.get('user', 'user{0}'.format(len(api.mentions) % 50)))
+        if supervisor.webhook :
+            send_event(url, supervisor.webhook.secret, {'for_user_id': str(api.bot.id), 'tweet_create_events': [status.json(args.truncate)]})
+        delay = mention.get('delay', (1 / args.rate) if args.rate > 0 else 0)
+        if delay > 0 :
+            sleep(delay)
+    # Until every module is done with every mention
+    while sum(1 for x, mods in list(routed.items()) if done.get(x, 0) >= len(mods)) < len(mentions) and perf_counter() - began < args.timeout :
+        sleep(0.05)
+    # And the outbox to send them all
+    bot = supervisor.bots[0]
+    while bot.outbox and bot.outbox.pending > 0 and perf_counter() - began < args.timeout :
+        sleep(0.05)
+    elapsed = perf_counter() - began
+    supervisor.stop()
+
+    # Report
+    replied = set(x for x, _, _ in api.replies)
+    finished = sum(1 for x, mods in list(routed.items()) if done.get(x, 0) >= len(mods))
+    latencies = {}
+    for in_reply_to, at, thread in api.replies:
+        if in_reply_to in api.posted :
+            latencies.setdefault(thread.split(':', 1)[-1] if thread.startswith('bench:') else 'other', []).append(at - api.posted[in_reply_to])
+    print("Mentions: {0}, handled: {1}, replied: {2}, in {3:.2f}s, {4:.1f} mentions/s".format(len(mentions), finished, len(replied), elapsed, finished / elapsed))
+    print("\n{0:<12} {1:>8} {2:>10} {3:>10} {4:>10} {5:>12}".format('module', 'replies', 'p50 (s)', 'p95 (s)', 'p99 (s)', 'handler (s)'))
+    for name in sorted(set(latencies) | set(handled)):
+        values = latencies.get(name, [])
+        handler = handled.get(name, [])
+        print("{0:<12} {1:>8} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>12.4f}".format(name, len(values),
+            percentile(values, 50), percentile(values, 95), percentile(values, 99), sum(handler) / max(len(handler), 1)))
+    print("\n{0:<28} {1:>8} {2:>14}".format('endpoint', 'calls', 'per mention'))
+    for endpoint, count in api.calls.items():
+        count -= calls_before.get(endpoint, 0)
+        print("{0:<28} {1:>8} {2:>14.3f}".format(endpoint, count, count / max(len(mentions), 1)))
+    exit(0)
+
+if __name__ == '__main__' :
+    main()
@@ -27,6 +27,10 @@ from chatterbot import ChatBot
 from chatterbot.comparisons import SpacySimilarity
 from chatterbot.trainers import ChatterBotCorpusTrainer
 from argparse import ArgumentParser
+import logging
+
+# Tagger of a worker process of the bulk trainer
+__tagger__ = None
 
 def get_database_uri(config):
     from os import environ
@@ -37,25 +41,178 @@ def get_database_uri(config):
     else:
         raise ConnectionError("Failed to get database URI! Provide it in the config or through DATABASE_URL environment variable!")
 
+def __init_worker__():
+    global __tagger__
+    from chatterbot.tagging import PosLemmaTagger
+    __tagger__ = PosLemmaTagger()
+
+def __tag__(conversations, tagger=None, batch_size=256):
+    ''' Gives the search texts for the texts of the conversations, running spaCy over all of them in batches '''
+    tagger = tagger or __tagger__
+    texts = list(set(text for conversation in conversations for text in conversation))
+    nlp = tagger.nlp
+    docs = dict(zip(texts, nlp.pipe(texts, batch_size=batch_size)))
+    # The tagger looks up the documents already made by the batches, its own logic stays as it is
+    tagger.nlp = lambda text: docs[text] if text in docs else nlp(text)
+    try:
+        return [[tagger.get_text_index_string(text) for text in conversation] for conversation in conversations]
+    finally:
+        tagger.nlp = nlp
+
+class BulkTrainer:
+    '''
+        Trains with many corpus files at once, tagging the statements in batches over a pool of
+        processes and inserting them in bulk. The hashes of the files and conversations already
+        trained with are saved in the database, and those are skipped the next time
+    '''
+    def __init__(self, chatbot, jobs=1, batch_size=1000):
+        import sqlalchemy as sa
+        self.chatbot = chatbot
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.logger = logging.getLogger(self.__class__.__name__)
+        meta = sa.MetaData()
+        self.ledger = sa.Table('prajnah_corpus', meta,
+            sa.Column('hash', sa.String(40), primary_key=True),
+            sa.Column('kind', sa.String(16)),
+            sa.Column('source', sa.String(255)))
+        meta.create_all(chatbot.storage.engine)
+
+    @staticmethod
+    def hash(*data):
+        import hashlib, json
+        return hashlib.sha1(json.dumps(data, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def __trained__(self):
+        with self.chatbot.storage.engine.begin() as conn:
+            return set(x.hash for x in conn.execute(self.ledger.select()))
+
+    def __record__(self, hashes, kind, source):
+        if len(hashes) > 0 :
+            with self.chatbot.storage.engine.begin() as conn:
+                conn.execute(self.ledger.insert(), [{'hash': x, 'kind': kind, 'source': source[-255:]} for x in hashes])
+
+    def __create__(self, statements, hashes, source):
+        ''' Inserts the statements along with their ledger rows, in one transaction '''
+        storage = self.chatbot.storage
+        session = storage.Session()
+        Session = storage.Session
+        try:
+            session.execute(self.ledger.insert(), [{'hash': x, 'kind': kind, 'source': source[-255:]} for x, kind in hashes])
+            # create_many commits the session it gets, the ledger rows already in it go along
+            storage.Session = lambda: session
+            storage.create_many(statements)
+        except:
+            session.rollback()
+            raise
+        finally:
+            storage.Session = Session
+            session.close()
+
+    def __chunks__(self, conversations):
+        chunk, size = [], 0
+        for conversation in conversations:
+            chunk.append(conversation)
+            size += len(conversation)
+            if size >= self.batch_size :
+                yield chunk
+                chunk, size = [], 0
+        if chunk :
+            yield chunk
+
+    def __statements__(self, conversations, search_texts, categories):
+        Statement = self.chatbot.storage.get_object('statement')
+        statements = []
+        for conversation, conversation_search_texts in zip(conversations, search_texts):
+            previous_text, previous_search_text = None, ''
+            for text, search_text in zip(conversation, conversation_search_texts):
+                statement = Statement(text=text, search_text=search_text, in_response_to=previous_text,
+                    search_in_response_to=previous_search_text, conversation='training')
+                statement.add_tags(*categories)
+                for preprocessor in self.chatbot.preprocessors:
+                    statement = preprocessor(statement)
+                previous_text, previous_search_text = statement.text, search_text
+                statements.append(statement)
+        return statements
+
+    def train(self, *paths):
+        ''' Trains with the corpus files, and all of those inside the directories '''
+        import os
+        from time import time
+        from multiprocessing import Pool
+        from chatterbot.corpus import list_corpus_files, read_corpus
+
+        trained = self.__trained__()
+        files = [x for path in paths for x in (list_corpus_files(path) if os.path.isdir(path) else [path])]
+        work = []
+        for file_path in files:
+            with open(file_path, 'rb') as corpus_file:
+                file_hash = self.hash(corpus_file.read().decode('utf-8'))
+            if file_hash in trained :
+                self.logger.info("Skipping {0}, already trained".format(file_path))
+                continue
+            trained.add(file_hash)
+            corpus = read_corpus(file_path)
+            categories = corpus.get('categories', [])
+            # The same conversation may come more than once, in a file or across them
+            conversations = []
+            for conversation in corpus.get('conversations', []):
+                conversation_hash = self.hash(categories, conversation)
+                if conversation_hash not in trained :
+                    trained.add(conversation_hash)
+                    conversations.append((conversation_hash, conversation))
+            self.logger.info("{0}: {1} new conversations".format(file_path, len(conversations)))
+            work.append((file_path, file_hash, categories, conversations))
+
+        total = sum(len(x) for _, _, _, conversations in work for _, x in conversations)
+        done, began = 0, time()
+        pool = Pool(self.jobs, initializer=__init_worker__) if self.jobs > 1 else None
+        try:
+            for file_path, file_hash, categories, conversations in work:
+                chunks = list(self.__chunks__(conversations))
+                if pool :
+                    results = pool.imap(__tag__, [[x for _, x in chunk] for chunk in chunks])
+                else:
+                    results = (__tag__([x for _, x in chunk], self.chatbot.storage.tagger) for chunk in chunks)
+                for i, (chunk, search_texts) in enumerate(zip(chunks, results)):
+                    statements = self.__statements__([x for _, x in chunk], search_texts, categories)
+                    # The file is done with its last chunk
+                    hashes = [(h, 'conversation') for h, _ in chunk] + ([(file_hash, 'file')] if i == len(chunks) - 1 else [])
+                    self.__create__(statements, hashes, file_path)
+                    done += len(statements)
+                    self.logger.info("Trained {0}/{1} statements, {2:.0f} statements/s".format(done, total, done / max(time() - began, 1e-6)))
+                if len(chunks) == 0 :
+                    self.__record__([file_hash], 'file', file_path)
+        finally:
+            if pool :
+                pool.close()
+                pool.join()
+        self.logger.info("Done, {0} statements in {1:.1f}s".format(done, time() - began))
+
 def main():
     parser = ArgumentParser(description="Helps training the aitalk module with chat corpus files")
     parser.add_argument('-c', '--config', help="Config file (default: config.json)", dest='config', nargs=1, type=str, default=['config.json'])
-    parser.add_argument('-f', '--file', help="Trainer file", dest='file', nargs=1, type=str)
+    parser.add_argument('-f', '--file', help="Trainer files (or directories with --bulk)", dest='file', nargs='+', type=str)
     parser.add_argument('-n', '--name', help="Bot name", dest='name', nargs=1, type=str)
     parser.add_argument('-d', '--database', help="Database URI", dest='dburi', nargs=1, type=str)
+    parser.add_argument('-b', '--bulk', help="Train in bulk, skipping the conversations already trained with", action='store_true', dest='bulk')
+    parser.add_argument('-j', '--jobs', help="Number of processes tagging the statements with --bulk (default: 1)", dest='jobs', type=int, default=1)
+    parser.add_argument('--batch-size', help="Number of statements tagged and inserted together with --bulk (default: 1000)", dest='batch_size', type=int, default=1000)
     parser.add_argument('-V', '--version', action='version', version='%(prog)s 0.1')
     args = parser.parse_args()
 
     from TwitterPrajnah import Config
     config = Config(args.config[0])
 
-    if not (len(args.file)>0 and len(args.file[0])>0) :
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(name)-12s - %(message)s', level=logging.INFO)
+
+    if not (args.file and len(args.file[0])>0) :
         raise Exception("No file to train!")
     
-    if not (len(args.name)>0 and len(args.name[0])>0) :
+    if not (args.name and len(args.name[0])>0) :
         raise Exception("No bot name given!")
     
-    if not (len(args.dburi)>0 and len(args.dburi[0])>0) :
+    if not (args.dburi and len(args.dburi[0])>0) :
         db_uri = get_database_uri(getattr(config, 'aitalk', None))
         if db_uri == None :
             raise Exception("No Database Url Provided!")
@@ -69,8 +226,17 @@ def main():
         storage_adapter='chatterbot.storage.SQLStorageAdapter',
         database_uri=db_uri
         )
-    trainer = ChatterBotCorpusTrainer(chatbot)
-    trainer.train(args.file[0])
+    # Same database settings as the bot, the indexes are made once the statements are in (faster than keeping them up while inserting)
+    from mods.aitalk import Storage
+    storage = Storage(getattr(config, 'aitalk', None), db_uri, logging.getLogger('PrajnahTrainer'))
+    storage.attach(chatbot.storage, replica=False, indexes=False)
+    if args.bulk :
+        BulkTrainer(chatbot, args.jobs, args.batch_size).train(*args.file)
+    else:
+        trainer = ChatterBotCorpusTrainer(chatbot)
+        trainer.train(*args.file)
+    if storage.indexes :
+        storage.index(chatbot.storage)
     exit(0)
 
 if __name__ == '__main__' :
@@ -63,14 +63,1040 @@ class Config:
     def __str__(self):
         return str(self._json)
 
+    def derive(self, overrides: dict):
+        ''' Gives a copy of the config with some attributes overridden, for ex: by an account '''
+        config = Config.__new__(Config)
+        values = dict(self._json)
+        values.pop('accounts', None)
+        values.update(overrides)
+        for k,v in values.items():
+            setattr(config, k, v)
+        config._json = values
+        return config
+
+class Metrics:
+    '''
+        Counters, gauges and latency histograms of the bot (polls, API endpoints, module hooks,
+        DB operations, queue depths and rate limit waits), served in the Prometheus text format
+        on a local HTTP endpoint and/or logged as a JSON summary periodically. When disabled,
+        recording does nothing
+    '''
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, config):
+        import threading
+        from contextlib import nullcontext
+        metrics = getattr(config, 'metrics', None)
+        self.enabled = metrics is not None and metrics.get('enabled', True)
+        metrics = metrics or {}
+        self.host = metrics.get('host', '127.0.0.1')
+        self.port = metrics.get('port', None)
+        self.log_every = float(metrics.get('log_every', 300))
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.server = None
+        self.thread = None
+        self.__disabled__ = nullcontext()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def inc(self, name: str, value=1, **labels):
+        ''' Adds to a counter '''
+        if not self.enabled :
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        ''' Records a duration in a histogram '''
+        from bisect import bisect_left
+        if not self.enabled :
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None :
+                hist = self.histograms[key] = {'buckets': [0]*(len(self.BUCKETS) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            hist['buckets'][bisect_left(self.BUCKETS, seconds)] += 1
+            hist['sum'] += seconds
+            hist['count'] += 1
+            hist['max'] = max(hist['max'], seconds)
+
+    def gauge(self, name: str, value, **labels):
+        ''' Sets a gauge, to a number or to a function giving it when read (for queue depths) '''
+        if not self.enabled :
+            return
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def time(self, name: str, **labels):
+        ''' Context manager recording the time taken by its block in a histogram '''
+        if not self.enabled :
+            return self.__disabled__
+        return self.__timer__(name, labels)
+
+    def __timer__(self, name, labels):
+        from contextlib import contextmanager
+        from time import perf_counter
+        @contextmanager
+        def timer():
+            began = perf_counter()
+            try:
+                yield
+            finally:
+                self.observe(name, perf_counter() - began, **labels)
+        return timer()
+
+    def watch(self, engine, db: str):
+        ''' Times every statement run on an SQLAlchemy engine, by database and operation '''
+        from time import perf_counter
+        import sqlalchemy as sa
+        if not self.enabled :
+            return
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('prajnah_metrics', []).append(perf_counter())
+        def after(conn, cursor, statement, parameters, context, executemany):
+            began = conn.info['prajnah_metrics'].pop()
+            self.observe('prajnah_db_seconds', perf_counter() - began, db=db, op=statement.lstrip().split(None, 1)[0].upper())
+        sa.event.listen(engine, 'before_cursor_execute', before)
+        sa.event.listen(engine, 'after_cursor_execute', after)
+        def error(context):
+            if context.connection is not None and context.connection.info.get('prajnah_metrics') :
+                context.connection.info['prajnah_metrics'].pop()
+            self.inc('prajnah_db_errors_total', db=db)
+        sa.event.listen(engine, 'handle_error', error)
+
+    @staticmethod
+    def __labels__(labels, extra=()):
+        labels = tuple(labels) + tuple(extra)
+        if not labels :
+            return ''
+        return '{' + ','.join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+    def __read__(self):
+        ''' Gives a snapshot of the counters, gauges (read now) and histograms '''
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in self.histograms.items()}
+        for key, value in gauges.items():
+            try:
+                gauges[key] = value() if callable(value) else value
+            except:
+                gauges[key] = float('nan')
+        return counters, gauges, histograms
+
+    def render(self):
+        ''' Gives all the metrics in the Prometheus text format '''
+        counters, gauges, histograms = self.__read__()
+        lines, typed = [], set()
+        for kind, values in (('counter', counters), ('gauge', gauges)):
+            for (name, labels), value in sorted(values.items()):
+                if name not in typed :
+                    typed.add(name)
+                    lines.append('# TYPE {0} {1}'.format(name, kind))
+                lines.append('{0}{1} {2}'.format(name, self.__labels__(labels), value))
+        for (name, labels), hist in sorted(histograms.items()):
+            if name not in typed :
+                typed.add(name)
+                lines.append('# TYPE {0} histogram'.format(name))
+            total = 0
+            for le, count in zip(self.BUCKETS + ('+Inf',), hist['buckets']):
+                total += count
+                lines.append('{0}_bucket{1} {2}'.format(name, self.__labels__(labels, [('le', le)]), total))
+            lines.append('{0}_sum{1} {2}'.format(name, self.__labels__(labels), hist['sum']))
+            lines.append('{0}_count{1} {2}'.format(name, self.__labels__(labels), hist['count']))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self):
+        ''' Gives all the metrics as a dict, the histograms summed up as count, mean and max '''
+        counters, gauges, histograms = self.__read__()
+        name = lambda key: key[0] + self.__labels__(key[1])
+        summary = {name(k): v for k, v in sorted(counters.items())}
+        summary.update({name(k): v for k, v in sorted(gauges.items())})
+        summary.update({name(k): {'count': v['count'], 'mean': round(v['sum']/v['count'], 6) if v['count'] else 0, 'max': round(v['max'], 6)} \
+            for k, v in sorted(histograms.items())})
+        return summary
+
+    def __logger__(self):
+        while not self.stopping.wait(self.log_every) :
+            self.logger.info(json.dumps(self.summary()))
+
+    def start(self):
+        ''' Starts the HTTP endpoint and the summary logs, if configured '''
+        import threading
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        if not self.enabled :
+            return
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics') :
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, format, *args):
+                metrics.logger.debug(format % args)
+        if self.port is not None :
+            self.server = ThreadingHTTPServer((self.host, int(self.port)), Handler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='Metrics', daemon=True).start()
+            self.logger.info("Serving metrics on http://{0}:{1}/metrics".format(self.host, self.server.server_port))
+        if self.log_every > 0 :
+            self.thread = threading.Thread(target=self.__logger__, name='MetricsLog', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        ''' Stops the HTTP endpoint and logs the summary one last time '''
+        if not self.enabled :
+            return
+        self.stopping.set()
+        if self.server :
+            self.server.shutdown()
+            self.server.server_close()
+        if self.thread :
+            self.thread.join()
+            self.logger.info(json.dumps(self.summary()))
+
+class Tracer:
+    '''
+        Traces the handling of each mention: every mention gets a trace (with its own id) of nested
+        spans timing the steps, the API calls, twck, the dispatch queues, the module handlers and
+        whatever the modules time within, followed across threads and the event loop. The traces
+        slower than a threshold are appended to a JSONL file. When disabled, tracing does nothing
+    '''
+    def __init__(self, config):
+        import threading, contextvars
+        from contextlib import nullcontext
+        tracing = getattr(config, 'tracing', None)
+        self.enabled = tracing is not None and tracing.get('enabled', True)
+        tracing = tracing or {}
+        self.slow = float(tracing.get('slow_ms', 1000))/1000
+        self.path = tracing.get('path', 'traces.jsonl')
+        self.sample = float(tracing.get('sample', 1))
+        self.current = contextvars.ContextVar('prajnah_trace', default=None)
+        self.lock = threading.Lock()
+        self.__disabled__ = nullcontext()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def trace(self, tweet):
+        ''' Context manager tracing the handling of a mention, its block being the root span '''
+        import random
+        from uuid import uuid4
+        from time import time
+        if not self.enabled or (self.sample < 1 and random.random() >= self.sample) :
+            return self.__disabled__
+        trace = {'trace_id': uuid4().hex[:16], 'tweet_id': tweet.id, 'user': tweet.user.screen_name, 'time': time(),
+            'spans': [], 'totals': {}, 'open': 0, 'done': False}
+        return self.__span__(trace, None, 'mention', {})
+
+    def span(self, name: str, **attrs):
+        ''' Context manager timing its block as a span of the current trace, if any '''
+        if not self.enabled :
+            return self.__disabled__
+        current = self.current.get()
+        if current is None :
+            return self.__disabled__
+        return self.__span__(current[0], current[1], name, attrs)
+
+    def accumulate(self, name: str):
+        ''' Context manager adding the time of its block to a total of the current trace, for the steps run too many times to be spans '''
+        if not self.enabled or self.current.get() is None :
+            return self.__disabled__
+        return self.__accumulate__(self.current.get()[0], name)
+
+    def handoff(self, name: str, **attrs):
+        ''' Starts a span handing the current trace over to another thread (through a queue), ended by resume on the other end '''
+        if not self.enabled :
+            return None
+        current = self.current.get()
+        if current is None :
+            return None
+        return (current[0], self.__begin__(current[0], current[1], name, attrs))
+
+    def resume(self, handoff):
+        ''' Context manager ending the handoff span and continuing its trace within its block '''
+        if handoff is None :
+            return self.__disabled__
+        return self.__resume__(*handoff)
+
+    def watch(self, engine, db: str):
+        ''' Adds the time of the statements run on an SQLAlchemy engine to the totals of the traces they're run in '''
+        from time import perf_counter
+        import sqlalchemy as sa
+        if not self.enabled :
+            return
+        def before(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('prajnah_trace', []).append(perf_counter())
+        def after(conn, cursor, statement, parameters, context, executemany):
+            began = conn.info['prajnah_trace'].pop()
+            current = self.current.get()
+            if current is not None :
+                self.__add__(current[0], "db:{0}".format(db), perf_counter() - began)
+        sa.event.listen(engine, 'before_cursor_execute', before)
+        sa.event.listen(engine, 'after_cursor_execute', after)
+
+    def __begin__(self, trace, parent, name, attrs):
+        import threading
+        from time import perf_counter
+        span = {'parent': parent['id'] if parent else None, 'name': name, 'attrs': attrs, 'start': perf_counter(),
+            'thread': threading.current_thread().name}
+        with self.lock:
+            trace['open'] += 1
+            span['id'] = len(trace['spans'])
+            trace['spans'].append(span)
+        return span
+
+    def __end__(self, trace, span=None):
+        from time import perf_counter
+        if span is not None :
+            span['duration'] = perf_counter() - span['start']
+        with self.lock:
+            trace['open'] -= 1
+            finished = trace['open'] == 0 and not trace['done']
+            trace['done'] = trace['done'] or finished
+        if finished :
+            self.__finish__(trace)
+
+    def __add__(self, trace, name, seconds):
+        with self.lock:
+            total = trace['totals'].setdefault(name, [0, 0.0])
+            total[0] += 1
+            total[1] += seconds
+
+    def __span__(self, trace, parent, name, attrs):
+        from contextlib import contextmanager
+        @contextmanager
+        def span():
+            span = self.__begin__(trace, parent, name, attrs)
+            token = self.current.set((trace, span))
+            try:
+                yield span
+            finally:
+                self.current.reset(token)
+                self.__end__(trace, span)
+        return span()
+
+    def __resume__(self, trace, handoff):
+        from contextlib import contextmanager
+        @contextmanager
+        def resume():
+            # Keeps the trace open while continuing it here
+            with self.lock:
+                trace['open'] += 1
+            self.__end__(trace, handoff)
+            token = self.current.set((trace, trace['spans'][handoff['parent']] if handoff['parent'] is not None else None))
+            try:
+                yield
+            finally:
+                self.current.reset(token)
+                self.__end__(trace)
+        return resume()
+
+    def __accumulate__(self, trace, name):
+        from contextlib import contextmanager
+        from time import perf_counter
+        @contextmanager
+        def accumulate():
+            began = perf_counter()
+            try:
+                yield
+            finally:
+                self.__add__(trace, name, perf_counter() - began)
+        return accumulate()
+
+    def __finish__(self, trace):
+        ''' Writes the trace if it was slow '''
+        root = trace['spans'][0]
+        if root['duration'] < self.slow and max(x['start'] + x.get('duration', 0) for x in trace['spans']) - root['start'] < self.slow :
+            return
+        ms = lambda x: round(x*1000, 3)
+        record = {
+            'trace_id': trace['trace_id'], 'tweet_id': trace['tweet_id'], 'user': trace['user'], 'time': trace['time'],
+            'duration_ms': ms(max(x['start'] + x.get('duration', 0) for x in trace['spans']) - root['start']),
+            'spans': [dict({'id': x['id'], 'parent': x['parent'], 'name': x['name'], 'thread': x['thread'],
+                'start_ms': ms(x['start'] - root['start']), 'duration_ms': ms(x.get('duration', 0))}, **x['attrs']) for x in trace['spans']],
+            'totals': dict((k, {'count': v[0], 'ms': ms(v[1])}) for k, v in trace['totals'].items())
+        }
+        try:
+            with self.lock, open(self.path, 'a') as traces:
+                traces.write(json.dumps(record) + '\n')
+        except OSError:
+            self.logger.exception("Failed to write the trace!")
+
+class Profiler:
+    '''
+        Sampling profiler turned on and off on demand (by SIGUSR1). While on, a thread samples the
+        stacks of all the threads at an interval, and once turned off (or after some seconds) the
+        samples are written as collapsed stacks, the input of flamegraph.pl and speedscope. Costs
+        nothing while off
+    '''
+    def __init__(self, config):
+        import threading
+        profiler = getattr(config, 'profiler', None) or {}
+        self.seconds = float(profiler.get('seconds', 30))
+        self.interval = float(profiler.get('interval_ms', 5))/1000
+        self.dir = profiler.get('dir', '.')
+        self.thread = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def toggle(self):
+        ''' Starts profiling, or stops it if running '''
+        import threading
+        with self.lock:
+            if self.thread and self.thread.is_alive() :
+                self.stopping.set()
+                return
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.__sample__, name='Profiler', daemon=True)
+            self.thread.start()
+
+    def __sample__(self):
+        import os, sys, threading
+        from time import time, strftime
+        self.logger.info("Profiling for {0:.0f}s (or until toggled again)..".format(self.seconds))
+        counts, samples, began, own = {}, 0, time(), threading.get_ident()
+        while not self.stopping.wait(self.interval) and time() - began < self.seconds :
+            names = dict((x.ident, x.name) for x in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own :
+                    continue
+                stack = []
+                while frame is not None :
+                    code = frame.f_code
+                    stack.append("{0} ({1}:{2})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(';', ':'))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ':'))
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            samples += 1
+        path = os.path.join(self.dir, "profile-{0}-{1}.folded".format(strftime('%Y%m%d-%H%M%S'), os.getpid()))
+        try:
+            with open(path, 'w') as folded:
+                for stack, count in sorted(counts.items()):
+                    folded.write("{0} {1}\n".format(stack, count))
+            self.logger.info("Wrote {0} samples over {1:.1f}s to {2}".format(samples, time() - began, path))
+        except OSError:
+            self.logger.exception("Failed to write the profile!")
+
+class RateLimiter:
+    '''
+        Keeps the rate limit budget of each API endpoint separately, as reported by the
+        x-rate-limit-remaining and x-rate-limit-reset headers, and paces the calls so that
+        only the calls to an exhausted endpoint wait, and only until its reset time
+    '''
+    def __init__(self, default_wait, pace=0.2, metrics=None):
+        import threading
+        self.default_wait = default_wait
+        self.pace = pace
+        self.metrics = metrics
+        self.budgets = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    def endpoint(url: str):
+        ''' Gives the endpoint name for an API url, for ex: statuses/mentions_timeline '''
+        from urllib.parse import urlparse
+        path = urlparse(url).path.strip('/')
+        if path.endswith('.json'):
+            path = path[:-len('.json')]
+        return path.split('/', 1)[-1] if path.startswith('1.1/') else path
+
+    def update(self, response):
+        ''' Updates the budget of the endpoint from the headers of a response '''
+        if response is None or 'x-rate-limit-remaining' not in response.headers :
+            return
+        endpoint = self.endpoint(response.url)
+        with self.lock:
+            self.budgets[endpoint] = {
+                'remaining': int(response.headers['x-rate-limit-remaining']),
+                'limit': int(response.headers.get('x-rate-limit-limit', 0)),
+                'reset': float(response.headers.get('x-rate-limit-reset', 0)),
+                'last': self.budgets.get(endpoint, {}).get('last', 0)
+            }
+        self.logger.debug({endpoint: self.budgets[endpoint]})
+
+    def exhaust(self, endpoint: str, response=None):
+        ''' Marks the endpoint as exhausted until its reset time (or default wait if unknown) '''
+        from time import time
+        self.update(response)
+        with self.lock:
+            budget = self.budgets.setdefault(endpoint, {'limit': 0, 'last': 0})
+            budget['remaining'] = 0
+            if budget.get('reset', 0) <= time():
+                budget['reset'] = time() + self.default_wait
+            return budget['reset'] - time()
+
+    def remaining(self, endpoint: str):
+        ''' Remaining calls for the endpoint in the current window, None if not known yet '''
+        from time import time
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if budget is None :
+                return None
+            if budget['reset'] <= time():
+                return budget['limit'] or None
+            return budget['remaining']
+
+    def wait_time(self, endpoint: str):
+        ''' Time in seconds to wait before the next call to the endpoint '''
+        from time import time
+        now = time()
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if budget is None or budget['reset'] <= now :
+                return 0
+            if budget['remaining'] <= 0 :
+                return budget['reset'] - now
+            # Running low? spread the remaining calls over the rest of the window
+            if budget['limit'] and budget['remaining'] < budget['limit']*self.pace :
+                return max(budget['last'] + (budget['reset'] - now)/budget['remaining'] - now, 0)
+            return 0
+
+    def acquire(self, endpoint: str, block=True):
+        ''' Waits (if needed) and takes a call from the budget of the endpoint, returns False if it would wait but block is False '''
+        from time import time
+        while True:
+            wait = self.wait_time(endpoint)
+            if wait <= 0 :
+                break
+            if not block :
+                return False
+            self.logger.info("Waiting {0:.1f}s for {1}..".format(wait, endpoint))
+            if self.metrics :
+                self.metrics.inc('prajnah_ratelimit_wait_seconds_total', wait, endpoint=endpoint)
+            sleep(wait)
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if budget :
+                budget['remaining'] -= 1
+                budget['last'] = time()
+        return True
+
+class Checkpoint:
+    '''
+        Persists the polling position (high-water mark) of an account along with a ledger of the
+        tweets claimed for processing beyond it, so that the bot resumes where it stopped after a
+        restart and never replies to the same tweet twice. Uses the database at checkpoint.uri
+        (or DATABASE_URL, or a local sqlite file)
+    '''
+    def __init__(self, config, account: str):
+        import threading
+        from os import environ
+        import sqlalchemy as sa
+
+        checkpoint = getattr(config, 'checkpoint', None) or {}
+        uri = checkpoint.get('uri', None) or environ.get('DATABASE_URL', None) or 'sqlite:///checkpoint.db'
+        self.account = account
+        self.keep = int(checkpoint.get('keep', 1000))
+        self.last_statusid = None
+        self.processed = set()
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.engine = sa.create_engine(uri)
+        meta = sa.MetaData()
+        self.marks = sa.Table('prajnah_checkpoint', meta,
+            sa.Column('account', sa.String(64), primary_key=True),
+            sa.Column('last_statusid', sa.BigInteger))
+        self.ledger = sa.Table('prajnah_processed', meta,
+            sa.Column('account', sa.String(64), primary_key=True),
+            sa.Column('status_id', sa.BigInteger, primary_key=True, autoincrement=False))
+        meta.create_all(self.engine)
+
+    def load(self):
+        ''' Loads the saved high-water mark and the processed ledger, returns the high-water mark '''
+        with self.engine.begin() as conn:
+            row = conn.execute(self.marks.select().where(self.marks.c.account == self.account)).fetchone()
+            rows = conn.execute(self.ledger.select().where(self.ledger.c.account == self.account)).fetchall()
+        with self.lock:
+            self.last_statusid = row.last_statusid if row else None
+            self.processed = set(r.status_id for r in rows)
+        self.logger.info("Resuming {0} from {1} ({2} tweets in ledger)".format(self.account, self.last_statusid, len(self.processed)))
+        return self.last_statusid
+
+    def claim(self, status_ids):
+        ''' Records the tweets as processed in a single transaction, before they get processed '''
+        # Polling and webhooks may claim the same tweets at once, only one of them gets each
+        with self.lock:
+            status_ids = [x for x in status_ids if x not in self.processed and (self.last_statusid is None or x > self.last_statusid)]
+            if len(status_ids) == 0 :
+                return status_ids
+            with self.engine.begin() as conn:
+                conn.execute(self.ledger.insert(), [{'account': self.account, 'status_id': x} for x in status_ids])
+            self.processed.update(status_ids)
+        return status_ids
+
+    def advance(self, status_id):
+        ''' Moves the high-water mark forward, saved on the next flush '''
+        with self.lock:
+            if self.last_statusid is None or status_id > self.last_statusid :
+                self.last_statusid = status_id
+                self.dirty = True
+
+    def flush(self):
+        ''' Saves the high-water mark and trims the ledger to what lies beyond it '''
+        with self.lock:
+            if not self.dirty :
+                return
+            mark = self.last_statusid
+            self.processed = set(x for x in self.processed if x > mark)
+            # Bound the ledger even if the mark can't move forward (over the cap)
+            floor = sorted(self.processed)[-self.keep] if len(self.processed) > self.keep else None
+            if floor is not None :
+                self.processed = set(x for x in self.processed if x >= floor)
+            self.dirty = False
+        with self.engine.begin() as conn:
+            if conn.execute(self.marks.update().where(self.marks.c.account == self.account).values(last_statusid=mark)).rowcount == 0 :
+                conn.execute(self.marks.insert().values(account=self.account, last_statusid=mark))
+            conn.execute(self.ledger.delete().where(self.ledger.c.account == self.account).where(self.ledger.c.status_id <= mark))
+            if floor is not None :
+                conn.execute(self.ledger.delete().where(self.ledger.c.account == self.account).where(self.ledger.c.status_id < floor))
+        self.logger.debug({'account': self.account, 'last_statusid': mark})
+
+class Outbox:
+    '''
+        Durable queue of the tweets to send. The tweets are saved in the database (outbox.uri, or
+        DATABASE_URL, or a local sqlite file) and sent by a background sender at a steady pace,
+        retried with exponential backoff up to a number of attempts, so that the callers don't
+        wait and nothing queued is lost on a restart. The same reply to the same tweet is queued
+        only once, and long replies may be split into a thread
+    '''
+    LIMIT = 280
+    # Errors retrying won't fix: too long, replied to a deleted tweet
+    FATAL = (186, 385)
+    DUPLICATE = 187
+
+    def __init__(self, config, bot):
+        import threading
+        from os import environ
+        import sqlalchemy as sa
+
+        outbox = getattr(config, 'outbox', None) or {}
+        uri = outbox.get('uri', None) or environ.get('DATABASE_URL', None) or 'sqlite:///outbox.db'
+        self.bot = bot
+        self.account = bot.username
+        self.pace = float(outbox.get('pace', 1))
+        self.max_attempts = max(int(outbox.get('max_attempts', 5)), 1)
+        self.backoff = float(outbox.get('backoff', 30))
+        self.max_backoff = float(outbox.get('max_backoff', 3600))
+        self.split = bool(outbox.get('split', False))
+        self.keep = float(outbox.get('keep', 24))*3600
+        self.trimmed = 0
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.__sender__, name="Outbox-{0}".format(self.account), daemon=True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        self.engine = sa.create_engine(uri)
+        meta = sa.MetaData()
+        self.queue = sa.Table('prajnah_outbox', meta,
+            sa.Column('id', sa.Integer, primary_key=True),
+            sa.Column('account', sa.String(64), nullable=False),
+            # 0 when not a reply, NULLs would never be equal in the unique key
+            sa.Column('in_reply_to', sa.BigInteger, nullable=False, default=0),
+            sa.Column('text_hash', sa.String(64), nullable=False),
+            sa.Column('text', sa.Text, nullable=False),
+            sa.Column('state', sa.String(8), nullable=False, default='queued'),
+            sa.Column('attempts', sa.Integer, nullable=False, default=0),
+            sa.Column('next_at', sa.Float, nullable=False),
+            sa.Column('part', sa.Integer, nullable=False, default=0),
+            sa.Column('reply_to', sa.BigInteger),
+            sa.Column('created', sa.Float, nullable=False),
+            sa.UniqueConstraint('account', 'in_reply_to', 'text_hash'),
+            sa.Index('ix_prajnah_outbox_due', 'account', 'state', 'next_at'))
+        meta.create_all(self.engine)
+        with self.engine.begin() as conn:
+            self.pending = conn.execute(sa.select([sa.func.count()]).select_from(self.queue) \
+                .where(self.queue.c.account == self.account).where(self.queue.c.state == 'queued')).scalar()
+        if self.pending > 0 :
+            self.logger.info("{0} tweet(s) of {1} left in the outbox, sending..".format(self.pending, self.account))
+
+    @staticmethod
+    def split_text(text: str, limit=LIMIT):
+        ''' Splits a long text at the spaces into parts numbered like (1/3), each within the limit '''
+        if len(text) <= limit :
+            return [text]
+        room = limit - len(' (99/99)')
+        parts, part = [], ''
+        for word in text.split():
+            while len(word) > room :
+                if part :
+                    parts.append(part)
+                    part = ''
+                parts.append(word[:room])
+                word = word[room:]
+            if part and len(part) + 1 + len(word) > room :
+                parts.append(part)
+                part = ''
+            part = "{0} {1}".format(part, word) if part else word
+        if part :
+            parts.append(part)
+        return ["{0} ({1}/{2})".format(x, i + 1, len(parts)) for i, x in enumerate(parts)]
+
+    def __parts__(self, text: str):
+        if self.split :
+            return self.split_text(text)
+        return [text if len(text) < self.LIMIT else "{0}...".format(text[:270])]
+
+    def put(self, text: str, in_reply_to=None):
+        ''' Queues a tweet (a reply if in_reply_to is given), returns False if the same one is already queued or sent '''
+        import hashlib
+        from time import time
+        import sqlalchemy as sa
+        now = time()
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(self.queue.insert().values(account=self.account, in_reply_to=in_reply_to or 0,
+                    text_hash=hashlib.sha256(text.encode()).hexdigest(), text=text, state='queued', attempts=0,
+                    next_at=now, part=0, reply_to=in_reply_to, created=now))
+        except sa.exc.IntegrityError:
+            self.logger.debug("Already queued: {0}".format(text[:50]))
+            return False
+        with self.lock:
+            self.pending += 1
+        self.wake.set()
+        return True
+
+    def __due__(self):
+        ''' Gives the next tweet to send, the one due first '''
+        with self.engine.begin() as conn:
+            return conn.execute(self.queue.select().where(self.queue.c.account == self.account).where(self.queue.c.state == 'queued') \
+                .order_by(self.queue.c.next_at, self.queue.c.id).limit(1)).fetchone()
+
+    def __update__(self, row, **values):
+        with self.engine.begin() as conn:
+            conn.execute(self.queue.update().where(self.queue.c.id == row.id).values(**values))
+
+    def __send__(self, row):
+        ''' Sends the remaining parts of a queued tweet, each part replying to the one before '''
+        from time import time
+        parts = self.__parts__(row.text)
+        reply_to = row.reply_to
+        for part in range(row.part, len(parts)):
+            try:
+                reply_to = self.bot.__post__(parts[part], reply_to).id
+            except tw.TweepError as err:
+                if getattr(err, 'api_code', None) == self.DUPLICATE and part == row.part :
+                    # The part recorded as next was sent already, before a restart most likely, the parts after it still go
+                    self.logger.info("Already sent: {0}".format(parts[part][:50]))
+                    self.bot.metrics.inc('prajnah_outbox_total', result='duplicate')
+                else:
+                    attempts = row.attempts + 1
+                    if attempts >= self.max_attempts or getattr(err, 'api_code', None) in self.FATAL :
+                        self.logger.error("Giving up on the tweet after {0} attempt(s): {1} ({2})".format(attempts, parts[part][:50], err))
+                        self.__update__(row, state='failed', attempts=attempts)
+                        with self.lock:
+                            self.pending -= 1
+                        self.bot.metrics.inc('prajnah_outbox_total', result='failed')
+                        return
+                    wait = min(self.backoff * 2**(attempts - 1), self.max_backoff)
+                    self.logger.warning("Failed to send the tweet, retrying in {0:.0f}s ({1}/{2}): {3}".format(wait, attempts, self.max_attempts, err))
+                    self.__update__(row, attempts=attempts, next_at=time() + wait)
+                    self.bot.metrics.inc('prajnah_outbox_total', result='retried')
+                    return
+            if part + 1 < len(parts) :
+                # Thread in progress, resume after the sent part on a restart
+                self.__update__(row, part=part + 1, reply_to=reply_to)
+                if self.stopping.wait(self.pace) :
+                    return
+        self.__update__(row, state='sent', part=len(parts), reply_to=reply_to)
+        with self.lock:
+            self.pending -= 1
+        self.bot.metrics.inc('prajnah_outbox_total', result='sent')
+
+    def __trim__(self):
+        ''' Forgets the sent and failed tweets older than keep '''
+        from time import time
+        with self.engine.begin() as conn:
+            conn.execute(self.queue.delete().where(self.queue.c.account == self.account).where(self.queue.c.state != 'queued') \
+                .where(self.queue.c.created < time() - self.keep))
+
+    def __sender__(self):
+        from time import time
+        while not self.stopping.is_set():
+            try:
+                if time() - self.trimmed > 3600 :
+                    self.__trim__()
+                    self.trimmed = time()
+                row = self.__due__()
+            except:
+                self.logger.exception("Failed to read the outbox!")
+                self.stopping.wait(self.backoff)
+                continue
+            if row is None or row.next_at > time() :
+                self.wake.wait(min(row.next_at - time(), 60) if row else 60)
+                self.wake.clear()
+                continue
+            try:
+                self.__send__(row)
+            except:
+                self.logger.exception("Failed to send from the outbox!")
+            self.stopping.wait(self.pace)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        ''' Stops the sender, whatever is left stays queued for the next start '''
+        self.stopping.set()
+        self.wake.set()
+        self.thread.join(timeout=self.pace + 10)
+        if self.pending > 0 :
+            self.logger.info("{0} tweet(s) of {1} left in the outbox".format(self.pending, self.account))
+
+class StatusCache:
+    '''
+        LRU cache of tweets with an expiry, filled with the mentions and the bot's own tweets.
+        Concurrent misses are coalesced into batched lookups of up to 100 tweets each
+    '''
+    BATCH_SIZE = 100
+
+    def __init__(self, size=1000, ttl=1800, window=0.05):
+        import threading
+        from collections import OrderedDict
+        self.size = size
+        self.ttl = ttl
+        self.window = window
+        self.entries = OrderedDict()
+        self.wanted = set()
+        self.inflight = set()
+        self.recent = {}
+        self.fetching = False
+        self.cond = threading.Condition()
+        self.hits, self.misses, self.lookups = 0, 0, 0
+
+    def __find__(self, status_id):
+        from time import time
+        entry = self.entries.get(status_id)
+        if entry is None :
+            return None
+        if entry[0] < time():
+            del self.entries[status_id]
+            return None
+        self.entries.move_to_end(status_id)
+        return entry[1]
+
+    def __store__(self, status):
+        from time import time
+        self.entries[status.id] = (time() + self.ttl, status)
+        self.entries.move_to_end(status.id)
+        while len(self.entries) > self.size :
+            self.entries.popitem(last=False)
+
+    def put(self, status):
+        ''' Caches a tweet '''
+        with self.cond:
+            self.__store__(status)
+
+    def get(self, status_id):
+        ''' Gives a cached tweet or None '''
+        with self.cond:
+            status = self.__find__(status_id)
+            if status is None :
+                self.misses += 1
+            else:
+                self.hits += 1
+            return status
+
+    def lookup(self, status_ids, fetch):
+        ''' Gives the tweets by ids (those that exist), fetching the missing ones in batches with fetch(ids) '''
+        found = {}
+        with self.cond:
+            for x in status_ids:
+                status = self.__find__(x)
+                if status is not None :
+                    found[x] = status
+            self.hits += len(found)
+            missing = [x for x in set(status_ids) if x not in found]
+            self.misses += len(missing)
+            self.wanted.update(missing)
+            while True:
+                for x in missing:
+                    # The last batch too, in case the cache is too small to hold it
+                    status = self.__find__(x) or self.recent.get(x, None)
+                    if status is not None :
+                        found[x] = status
+                missing = [x for x in missing if x not in found and (x in self.wanted or x in self.inflight)]
+                if len(missing) == 0 :
+                    return found
+                if self.fetching :
+                    self.cond.wait()
+                    continue
+                # Become the one fetching, wait a moment for others to add their misses to the batch
+                self.fetching = True
+                self.cond.wait(self.window)
+                batch = list(self.wanted)[:self.BATCH_SIZE]
+                self.wanted.difference_update(batch)
+                self.inflight = set(batch)
+                self.lookups += 1
+                self.cond.release()
+                try:
+                    statuses = fetch(batch)
+                except Exception:
+                    statuses = []
+                finally:
+                    self.cond.acquire()
+                for status in statuses:
+                    self.__store__(status)
+                self.recent = dict((x.id, x) for x in statuses)
+                self.inflight = set()
+                self.fetching = False
+                self.cond.notify_all()
+
+    def stats(self):
+        ''' Hit/miss counters of the cache '''
+        with self.cond:
+            return {'size': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'lookups': self.lookups}
+
+class WebhookReceiver:
+    '''
+        Embedded HTTP server receiving the account activity events (webhooks) of the accounts, so
+        that the mentions are handled as soon as they're tweeted instead of on the next poll. Answers
+        the CRC challenges and only takes the events signed with the consumer secret. Given a forward,
+        the events are handed over to it (with the account id) instead, for ex: to the worker processes
+    '''
+    def __init__(self, config, metrics=None, forward=None):
+        from os import environ
+        webhook = getattr(config, 'webhook', None) or {}
+        self.host = webhook.get('host', '0.0.0.0')
+        port = webhook.get('port', None)
+        self.port = int(port if port is not None else environ.get('PORT', 8080))
+        self.path = webhook.get('path', '/webhook')
+        self.secret = (webhook.get('secret', None) or getattr(config, 'api_secret', '')).encode()
+        self.metrics = metrics or Metrics(None)
+        self.forward = forward
+        self.bots = {}
+        self.server = None
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def register(self, bot):
+        ''' Routes the events for the account of the bot to it '''
+        self.bots[str(bot.me.id)] = bot
+
+    @staticmethod
+    def sign(secret: bytes, payload: bytes):
+        ''' Gives the signature of a payload, as in the x-twitter-webhooks-signature header '''
+        import hmac, hashlib, base64
+        return 'sha256=' + base64.b64encode(hmac.new(secret, payload, hashlib.sha256).digest()).decode()
+
+    def verify(self, payload: bytes, signature: str):
+        import hmac
+        return signature is not None and hmac.compare_digest(self.sign(self.secret, payload), signature)
+
+    @staticmethod
+    def decode(data: dict):
+        ''' Gives the tweet of an event in the shape of an extended mode one, with full_text '''
+        if 'extended_tweet' in data :
+            extended = data['extended_tweet']
+            return dict(data, full_text=extended['full_text'], entities=extended.get('entities', data.get('entities', {})))
+        return dict(data, full_text=data.get('full_text', data.get('text', '')))
+
+    def receive(self, payload: bytes):
+        ''' Feeds the tweets of an event to the bot of the account it's for '''
+        event = json.loads(payload)
+        if self.forward :
+            self.forward(str(event.get('for_user_id', '')), payload)
+            return
+        bot = self.bots.get(str(event.get('for_user_id', '')))
+        if bot is None :
+            self.logger.warning("Event for an unknown account: {0}".format(event.get('for_user_id', None)))
+            return
+        tweets = event.get('tweet_create_events', [])
+        self.metrics.inc('prajnah_webhook_events_total', len(tweets) or 1, kind='tweet_create' if tweets else 'other')
+        if len(tweets) > 0 :
+            bot.push([tw.Status.parse(bot.api, self.decode(x)) for x in tweets])
+
+    def start(self):
+        ''' Starts the HTTP server '''
+        import threading
+        from urllib.parse import urlparse, parse_qs
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        receiver = self
+        class Handler(BaseHTTPRequestHandler):
+            def reply(self, code, body=b'', content_type='application/json'):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def do_GET(self):
+                # The CRC challenge, for registering the webhook and once in a while after
+                url = urlparse(self.path)
+                token = parse_qs(url.query).get('crc_token', [None])[0]
+                if url.path != receiver.path or token is None :
+                    self.reply(404)
+                    return
+                self.reply(200, json.dumps({'response_token': receiver.sign(receiver.secret, token.encode())}).encode())
+            def do_POST(self):
+                if urlparse(self.path).path != receiver.path :
+                    self.reply(404)
+                    return
+                payload = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if not receiver.verify(payload, self.headers.get('x-twitter-webhooks-signature', None)) :
+                    receiver.metrics.inc('prajnah_webhook_rejected_total')
+                    receiver.logger.warning("Rejected an event with a bad signature from {0}".format(self.client_address[0]))
+                    self.reply(401)
+                    return
+                # Answer right away, the tweets are handled after
+                self.reply(200)
+                try:
+                    receiver.receive(payload)
+                except:
+                    receiver.logger.exception("Failed to handle the event!")
+            def log_message(self, format, *args):
+                receiver.logger.debug(format % args)
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='Webhook', daemon=True).start()
+        self.logger.info("Receiving webhooks on http://{0}:{1}{2}".format(self.host, self.server.server_port, self.path))
+
+    def stop(self):
+        ''' Stops the HTTP server '''
+        if self.server :
+            self.server.shutdown()
+            self.server.server_close()
+
 class TwitterBot:
-    def __init__(self, config: Config, callback, last_statusid=None):
+    def __init__(self, config: Config, callback, last_statusid=None, api=None, metrics=None, tracer=None):
         import threading
 
         # Init values
         self.ratelimit_wait = int(getattr(config, 'ratelimit_wait', 15))*60
         self.sleep_time = int(getattr(config, 'sleep_time', 1))*60
+        # Webhooks bring the mentions in, polling only fills the gaps (missed events, downtime)
+        if getattr(config, 'webhook', None) is not None and config.webhook.get('enabled', True) :
+            self.sleep_time = float(config.webhook.get('poll_every', 15))*60
+        self.ingest_mode = getattr(config, 'ingest_mode', 'extended')
+        self.page_size = min(int(getattr(config, 'page_size', 200)), 200)
+        self.max_per_poll = int(getattr(config, 'max_per_poll', 800))
+        # With a dispatcher (or on asyncio) the modules no longer run on this thread, so there's nothing to wait for between tweets
+        concurrent = (getattr(config, 'dispatch', None) is not None and config.dispatch.get('enabled', True)) or getattr(config, 'runtime', None) == 'asyncio'
+        self.request_delay = float(getattr(config, 'request_delay', 0 if concurrent else 3))
+        # Metrics given (shared with other bots) are started and stopped by whoever gave them
+        self.metrics = metrics or Metrics(config)
+        self.owns_metrics = metrics is None
+        self.tracer = tracer or Tracer(config)
+        self.ratelimit = RateLimiter(self.ratelimit_wait, float(getattr(config, 'ratelimit_pace', 0.2)), self.metrics)
+        status_cache = getattr(config, 'status_cache', None) or {}
+        self.status_cache = StatusCache(int(status_cache.get('size', 1000)), float(status_cache.get('ttl', 30))*60)
         self.last_statusid = last_statusid
+        self.pushed = set()
+        self.lock = threading.Lock()
         self.running = threading.Event()
         self.thread = threading.Thread(target=self.__bot_process__)
         self.config = config
@@ -82,10 +1108,13 @@ class TwitterBot:
             'last_statusid': last_statusid
         })
 
-        # Try logging with the twitter API
+        # Try logging with the twitter API (unless given one, like a mock for benchmarks)
         try:
-            self.auth = tw.OAuthHandler(config.api_key, config.api_secret)
-            self.api = self.__loginAPI__(config, self.auth)
+            if api is None :
+                self.auth = tw.OAuthHandler(config.api_key, config.api_secret)
+                self.api = self.__loginAPI__(config, self.auth)
+            else:
+                self.api, self.me = api, api.me()
             self.username = self.me.screen_name
             self.logger.info("Login successful: {0}".format(self.username))
         except tw.TweepError:
@@ -93,6 +1122,28 @@ class TwitterBot:
             # Throw error for a quickly abort the program
             raise TwitterConnectionError("Failed init twitter bot!")
         self.logger.debug({'me': self.me, 'username': self.username})
+        self.metrics.gauge('prajnah_status_cache_size', lambda: self.status_cache.stats()['size'], account=self.username)
+        self.metrics.gauge('prajnah_status_cache_hits', lambda: self.status_cache.stats()['hits'], account=self.username)
+        self.metrics.gauge('prajnah_status_cache_misses', lambda: self.status_cache.stats()['misses'], account=self.username)
+
+        # Resume from the saved checkpoint, if enabled
+        self.checkpoint = None
+        if getattr(config, 'checkpoint', None) is not None and config.checkpoint.get('enabled', True) :
+            self.checkpoint = Checkpoint(config, self.username)
+            self.metrics.watch(self.checkpoint.engine, 'checkpoint')
+            self.tracer.watch(self.checkpoint.engine, 'checkpoint')
+            if not self.last_statusid :
+                self.last_statusid = self.checkpoint.load()
+            else:
+                self.checkpoint.load()
+
+        # Tweets are sent from the outbox, if enabled
+        self.outbox = None
+        if getattr(config, 'outbox', None) is not None and config.outbox.get('enabled', True) :
+            self.outbox = Outbox(config, self)
+            self.metrics.watch(self.outbox.engine, 'outbox')
+            self.tracer.watch(self.outbox.engine, 'outbox')
+            self.metrics.gauge('prajnah_queue_depth', lambda: self.outbox.pending, queue='outbox', account=self.username)
         self.logger.info('Bot Initiated')
     
     def __loginAPI__(self, config, auth):
@@ -142,59 +1193,178 @@ class TwitterBot:
             i += 1
         return (j,k)
     
+    def __api_call__(self, endpoint, method, *args, **kwargs):
+        ''' Calls an API method within the rate limit budget of its endpoint, waits for the reset if rate-limited '''
+        from time import perf_counter
+        while True:
+            self.ratelimit.acquire(endpoint)
+            began = perf_counter()
+            try:
+                with self.tracer.span('api', endpoint=endpoint):
+                    result = method(*args, **kwargs)
+                self.metrics.observe('prajnah_api_seconds', perf_counter() - began, endpoint=endpoint)
+                self.ratelimit.update(self.api.last_response)
+                return result
+            except tw.RateLimitError as err:
+                self.metrics.inc('prajnah_api_ratelimited_total', endpoint=endpoint)
+                wait = self.ratelimit.exhaust(endpoint, getattr(err, 'response', None))
+                self.logger.warning("Rate-limited by the twitter api on {0}! Retrying after {1:.0f}s..".format(endpoint, wait))
+            except tw.TweepError:
+                self.metrics.inc('prajnah_api_errors_total', endpoint=endpoint)
+                raise
+
+    def __endpoint__(self, endpoint, method):
+        ''' Wraps an API method (keeping its attributes, for cursors) to go through the rate limit budget '''
+        from functools import wraps
+        @wraps(method)
+        def call(*args, **kwargs):
+            # Cursors ask for the method object with create=True, that's not an API call
+            if kwargs.get('create', False) :
+                return method(*args, **kwargs)
+            return self.__api_call__(endpoint, method, *args, **kwargs)
+        return call
+
     def __rtlimtc__(self, cursor):
-        ''' Handles rate limits within a cursor '''
+        ''' Iterates a cursor, its calls wait out the rate limits themselves (going through __endpoint__) '''
         while True:
             try:
                 yield cursor.next()
-            except tw.RateLimitError:
-                self.logger.warning("Rate-limited by the twitter api! Retrying after {0}s..".format(self.ratelimit_wait))
-                sleep(self.ratelimit_wait)
             except StopIteration:
                 return
     
+    def __fetch_mentions__(self):
+        ''' Fetches every mention since last_statusid (full pages, extended mode) and returns them oldest first '''
+        statuses, max_id = [], None
+        while True:
+            page = self.__api_call__('statuses/mentions_timeline', self.api.mentions_timeline, count=self.page_size,
+                since_id=self.last_statusid, max_id=max_id, tweet_mode='extended')
+            if len(page) == 0 :
+                break
+            statuses.extend(page)
+            max_id = page[-1].id - 1
+        statuses.reverse()
+        # Keep the oldest ones when capped, the rest gets picked up in the next poll
+        if self.max_per_poll > 0 :
+            statuses = statuses[:self.max_per_poll]
+        return statuses
+
     def __process_requests__(self):
         ''' Each time checks for new tweets and filters out the tagged ones and feeds it for processing '''
         self.logger.debug({'last_statusid': self.last_statusid})
-        if self.last_statusid :
-            for status in self.__rtlimtc__(tw.Cursor(self.api.mentions_timeline, count=5, since_id=self.last_statusid).items(5)):
-                if status.user.screen_name == self.username :
-                    continue
-                try:
+        # Mentions are out of budget? skip this poll rather than holding up the rest
+        if self.ratelimit.wait_time('statuses/mentions_timeline') > 0 :
+            self.logger.info("Skipping poll, mentions are rate-limited for now..")
+            return
+        if not self.last_statusid :
+            self.__advance__(self.__api_call__('statuses/mentions_timeline', self.api.mentions_timeline, count=1)[0].id)
+        elif self.ingest_mode == 'extended' :
+            statuses = self.__fetch_mentions__()
+            self.logger.debug("Fetched {0} new mentions".format(len(statuses)))
+            for status in statuses:
+                self.status_cache.put(self.twck(status))
+            # Get all the parent tweets not in this batch at once, modules most likely need them
+            parents = set(x.in_reply_to_status_id for x in statuses if x.user.screen_name != self.username and x.in_reply_to_status_id)
+            if len(parents) > 0 :
+                self.get_tweets(parents)
+            for status in statuses:
+                # Claimed one by one right before handling, a crash loses at most the tweet in hand
+                if status.user.screen_name != self.username and len(self.__claim__([status.id])) > 0 :
+                    self.metrics.inc('prajnah_mentions_total')
                     status = self.twck(status)
-                except tw.RateLimitError:
-                    self.logger.warning("Rate-limited by the twitter api! Retrying after {0}s..".format(self.ratelimit_wait))
-                    sleep(self.ratelimit_wait)
-                    status = self.twck(status)
-                
-                self.logger.getChild('__process_requests__').debug("Received: {0}".format(status.text))
-                self.__callback__(self, status)
-                self.last_statusid = status.id
-                sleep(3)
+                    self.logger.getChild('__process_requests__').debug("Received: {0}".format(status.text))
+                    with self.tracer.trace(status):
+                        self.__callback__(self, status)
+                    sleep(self.request_delay)
+                self.__advance__(status.id)
         else :
-            self.last_statusid = self.api.mentions_timeline(count=1)[0].id
+            mentions_timeline = self.__endpoint__('statuses/mentions_timeline', self.api.mentions_timeline)
+            for status in self.__rtlimtc__(tw.Cursor(mentions_timeline, count=5, since_id=self.last_statusid).items(5)):
+                if status.user.screen_name == self.username or len(self.__claim__([status.id])) == 0 :
+                    continue
+                status = self.twck(status)
+                self.metrics.inc('prajnah_mentions_total')
+
+                self.logger.getChild('__process_requests__').debug("Received: {0}".format(status.text))
+                with self.tracer.trace(status):
+                    self.__callback__(self, status)
+                self.__advance__(status.id)
+                sleep(self.request_delay)
+        if self.checkpoint :
+            self.checkpoint.flush()
+
+    def __claim__(self, status_ids):
+        ''' Gives the tweets out of these which are not processed yet, recording them as processed '''
+        if self.checkpoint :
+            return set(self.checkpoint.claim(status_ids))
+        # No ledger, only the pushed tweets ahead of the polling position need to be kept track of
+        with self.lock:
+            claimed = set(status_ids) - self.pushed
+            self.pushed |= claimed
+            self.pushed = set(x for x in self.pushed if self.last_statusid is None or x > self.last_statusid)
+        return claimed
+
+    def __advance__(self, status_id):
+        ''' Moves the polling position forward '''
+        self.last_statusid = status_id
+        if self.checkpoint :
+            self.checkpoint.advance(status_id)
+
+    def push(self, statuses):
+        ''' Handles the mentions among these tweets (received through webhooks) right away, polling skips them later '''
+        statuses = [self.twck(x) for x in statuses if x.user.id != self.me.id and \
+            any(m['screen_name'].lower() == self.username.lower() for m in x.entities.get('user_mentions', []))]
+        for status in statuses:
+            self.status_cache.put(status)
+        for status in statuses:
+            if len(self.__claim__([status.id])) > 0 :
+                self.metrics.inc('prajnah_mentions_total')
+                self.logger.getChild('push').debug("Received: {0}".format(status.text))
+                with self.tracer.trace(status):
+                    self.__callback__(self, status)
     
     def __bot_process__(self):
         ''' Starts the infinite loop of doing bot stuffs until exit signal is received '''
         while not self.running.wait(self.sleep_time) :
-            self.__process_requests__()
+            try:
+                with self.metrics.time('prajnah_poll_seconds'):
+                    self.__process_requests__()
+            except:
+                self.logger.exception("Error while polling!")
     
-    def get_tweet(self, tweet_id, ext=False):
-        ''' Helpful method to get tweets by id while taking precautions '''
+    def __lookup__(self, tweet_ids):
         try:
-            if ext :
-                return self.twck(self.api.get_status(id=tweet_id))
-            else :
-                self.api.get_status(id=tweet_id)
-        except tw.RateLimitError:
-            self.logger.warning("Rate-limited by the twitter api! Retrying after {0}s..".format(self.ratelimit_wait))
-            sleep(self.ratelimit_wait)
-            return self.get_tweet(tweet_id)
+            statuses = self.__api_call__('statuses/lookup', self.api.statuses_lookup, list(tweet_ids), tweet_mode='extended')
+        except tw.TweepError:
+            self.logger.exception("Failed to lookup tweets")
+            return []
+        return [self.twck(x) for x in statuses]
+
+    def get_tweets(self, tweet_ids):
+        ''' Gives the tweets by ids as a dict, from the cache or fetched in batches '''
+        tweets = self.status_cache.lookup(tweet_ids, self.__lookup__)
+        self.logger.debug({'status_cache': self.status_cache.stats()})
+        return tweets
+
+    def get_tweet(self, tweet_id, ext=False):
+        ''' Helpful method to get tweets by id while taking precautions, always with the complete text '''
+        status = self.get_tweets([tweet_id]).get(tweet_id, None)
+        if status is None :
+            # Not found by the lookup, let get_status tell why
+            status = self.twck(self.__api_call__('statuses/show', self.api.get_status, id=tweet_id, tweet_mode='extended'))
+            self.status_cache.put(status)
+        return status
     
     def twck(self, status):
         ''' Checks if the tweet needs to be extended to get the complete text of it '''
-        if status.truncated:
-            status = self.api.get_status(status.id, tweet_mode='extended')
+        with self.metrics.time('prajnah_twck_seconds'), self.tracer.span('twck'):
+            return self.__twck__(status)
+
+    def __twck__(self, status):
+        if hasattr(status, 'full_text'):
+            # Already fetched in extended mode, no need to fetch it again
+            status.text = status.full_text
+        elif status.truncated:
+            status = self.__api_call__('statuses/show', self.api.get_status, status.id, tweet_mode='extended')
             status.text = status.full_text
         status.just_text = status.text[self.__rangem(status.entities['user_mentions'])[1]:]
         return status
@@ -202,6 +1372,10 @@ class TwitterBot:
     def start(self):
         ''' Starts the bot '''
         self.logger.info('Starting bot..')
+        if self.owns_metrics :
+            self.metrics.start()
+        if self.outbox :
+            self.outbox.start()
         self.thread.start()
     
     def stop(self):
@@ -209,29 +1383,832 @@ class TwitterBot:
         self.logger.info('Stopping bot..')
         self.running.set()
         self.thread.join()
+        if self.outbox :
+            self.outbox.stop()
+        if self.checkpoint :
+            self.checkpoint.flush()
+        if self.owns_metrics :
+            self.metrics.stop()
     
     def tweet(self, text: str, replyto=None):
-        ''' Helps sending tweets ''' 
+        ''' Helps sending tweets, queued in the outbox if enabled ''' 
         self.logger.getChild('__process_requests__').debug("Sending: {0}{1}".format((" {0} -> ".format(replyto.id)) if replyto else '' , text))
+        if self.outbox :
+            self.outbox.put(text, replyto.id if replyto else None)
+            return
         try:
             if len(text) >= 280 :
                 text = "{0}...".format(text[:270])
-            if replyto :
-                self.api.update_status(status=text, in_reply_to_status_id=replyto.id, auto_populate_reply_metadata=True)
-            else:
-                self.api.update_status(status=text)
-        except tw.RateLimitError:
-            self.logger.warning("Rate-limited by the twitter api! Retrying after {0}s..".format(self.ratelimit_wait))
-            sleep(self.ratelimit_wait)
-            self.tweet(text, replyto)
+            self.__post__(text, replyto.id if replyto else None)
         except tw.TweepError:
             self.logger.exception("Failed to send the tweet")
 
-def main():
+    def __post__(self, text: str, in_reply_to=None):
+        ''' Posts a tweet right away, returns it '''
+        if in_reply_to :
+            status = self.__api_call__('statuses/update', self.api.update_status, status=text, in_reply_to_status_id=in_reply_to, auto_populate_reply_metadata=True, tweet_mode='extended')
+        else:
+            status = self.__api_call__('statuses/update', self.api.update_status, status=text, tweet_mode='extended')
+        # Replies to our own tweets need them back, keep them around
+        self.status_cache.put(self.twck(status))
+        return status
+
+class AsyncTwitterBot(TwitterBot):
+    '''
+        TwitterBot running on an asyncio event loop, the callback is a coroutine and many of them
+        run at once. The blocking tweepy (and module) calls run on an executor, and there are
+        coroutine versions of tweet, get_tweet and get_tweets for the modules with async hooks
+    '''
+    def __init__(self, config: Config, callback, last_statusid=None, api=None, metrics=None, tracer=None):
+        import asyncio, threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=int(getattr(config, 'async_workers', 32)))
+        self.inflight = threading.BoundedSemaphore(int(getattr(config, 'async_inflight', 64)))
+        self.conversations = {}
+        self.stopping = None
+        self.__handler__ = callback
+        super().__init__(config, self.__schedule__, last_statusid, api, metrics, tracer)
+        self.metrics.gauge('prajnah_inflight', lambda: sum(x[1] for x in list(self.conversations.values())), account=self.username)
+
+    async def run(self, method, *args, **kwargs):
+        ''' Runs a blocking method on the executor '''
+        import contextvars
+        from functools import partial
+        # In the context of the caller, for the trace to carry on
+        return await self.loop.run_in_executor(self.executor, partial(contextvars.copy_context().run, method, *args, **kwargs))
+
+    async def tweet_async(self, text: str, replyto=None):
+        return await self.run(self.tweet, text, replyto)
+
+    async def get_tweet_async(self, tweet_id, ext=False):
+        return await self.run(self.get_tweet, tweet_id, ext)
+
+    async def get_tweets_async(self, tweet_ids):
+        return await self.run(self.get_tweets, tweet_ids)
+
+    def __schedule__(self, bot, status):
+        ''' Hands over a tweet from the polling thread to the event loop, waits while too many are in flight '''
+        import asyncio
+        self.inflight.acquire()
+        asyncio.run_coroutine_threadsafe(self.__handle__(status, self.tracer.handoff('schedule')), self.loop)
+
+    async def __handle__(self, status, handoff=None):
+        import asyncio
+        # Tweets from the same user are handled in order
+        conversation = self.conversations.setdefault(status.user.id, [asyncio.Lock(), 0])
+        conversation[1] += 1
+        try:
+            async with conversation[0]:
+                with self.tracer.resume(handoff):
+                    await self.__handler__(self, status)
+        except:
+            self.logger.exception("Error while handling the tweet!")
+        finally:
+            conversation[1] -= 1
+            if conversation[1] == 0 :
+                del self.conversations[status.user.id]
+            self.inflight.release()
+
+    async def __poll__(self):
+        import asyncio
+        while True:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), self.sleep_time)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                with self.metrics.time('prajnah_poll_seconds'):
+                    await self.run(self.__process_requests__)
+            except:
+                self.logger.exception("Error while polling!")
+
+    async def __main__(self):
+        import asyncio
+        self.stopping = asyncio.Event()
+        if not self.running.is_set() :
+            await self.__poll__()
+        # Let the tweets in flight finish
+        pending = [x for x in asyncio.all_tasks() if x is not asyncio.current_task()]
+        if pending :
+            await asyncio.wait(pending)
+
+    def __bot_process__(self):
+        ''' Runs the event loop until exit signal is received '''
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_until_complete(self.__main__())
+        finally:
+            self.executor.shutdown(wait=True)
+            self.loop.close()
+
+    def stop(self):
+        ''' Stops the bot '''
+        self.logger.info('Stopping bot..')
+        self.running.set()
+        if self.stopping :
+            self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join()
+        if self.outbox :
+            self.outbox.stop()
+        if self.checkpoint :
+            self.checkpoint.flush()
+        if self.owns_metrics :
+            self.metrics.stop()
+
+class ModuleDispatcher:
+    '''
+        Runs module handlers concurrently, each module gets its own bounded pool of workers with
+        a bounded queue per worker. Tweets from the same user always land on the same worker of
+        a module, so the replies within a conversation keep their order.
+    '''
+    def __init__(self, config, handler):
+        dispatch = getattr(config, 'dispatch', None) or {}
+        self.workers = max(int(dispatch.get('workers', 1)), 1)
+        self.queue_size = max(int(dispatch.get('queue_size', 16)), 1)
+        self.limits = dispatch.get('modules', {})
+        self.lanes = {}
+        self.__handler__ = handler
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __worker__(self, mod, lane):
+        while True:
+            item = lane.get()
+            try:
+                if item is None :
+                    return
+                bot, tweet, handoff = item
+                with bot.tracer.resume(handoff):
+                    self.__handler__(mod, bot, tweet)
+            except Exception:
+                self.logger.exception("Failed to handle a tweet with {0}!".format(mod.__modname__))
+            finally:
+                lane.task_done()
+
+    def register(self, mod):
+        ''' Starts the workers for a module '''
+        import threading, queue
+        count = max(int(self.limits.get(mod.__modname__, self.workers)), 1)
+        lanes = []
+        for i in range(count):
+            lane = queue.Queue(maxsize=self.queue_size)
+            thread = threading.Thread(target=self.__worker__, args=(mod, lane), name="{0}-{1}".format(mod.__modname__, i), daemon=True)
+            thread.start()
+            lanes.append((lane, thread))
+        self.lanes[mod.__modname__] = lanes
+        self.logger.debug("Registered {0} with {1} worker(s)".format(mod.__modname__, count))
+
+    def depth(self, modname):
+        ''' Gives the number of tweets queued for a module '''
+        return sum(lane.qsize() for lane, _ in self.lanes.get(modname, []))
+
+    def dispatch(self, bot, tweet, modules=None):
+        ''' Queues the tweet for every registered module (or the ones given), blocks while a queue is full '''
+        for modname, lanes in self.lanes.items() if modules is None else ((x.__modname__, self.lanes[x.__modname__]) for x in modules):
+            lane, _ = lanes[hash(tweet.user.id) % len(lanes)]
+            if lane.full() :
+                self.logger.debug("Queue full for {0}, waiting..".format(modname))
+            lane.put((bot, tweet, bot.tracer.handoff('queue', module=modname)))
+
+    def stop(self):
+        ''' Lets the workers finish what's queued and stops them '''
+        for lanes in self.lanes.values():
+            for lane, _ in lanes:
+                lane.put(None)
+        for lanes in self.lanes.values():
+            for _, thread in lanes:
+                thread.join()
+
+class Router:
+    '''
+        Routes each tweet to only the modules it's meant for. Modules declare what they handle with
+        MODULE_PREFIXES (commands the text starts with), MODULE_PATTERNS (regexes searched in the
+        text) and MODULE_PREDICATE (a function of bot and tweet), or MODULE_FALLBACK to get the tweets
+        no other module matched. The prefixes go into a trie and the patterns into one combined
+        regex, so a tweet is matched against all of them in one pass. Modules declaring none of
+        these get every tweet
+    '''
+    def __init__(self, modules):
+        import re
+        self.modules = list(modules)
+        self.order = dict((x.__modname__, i) for i, x in enumerate(self.modules))
+        self.trie = {}
+        self.patterns = []
+        self.predicates = []
+        self.fallback = []
+        self.every = []
+        count = 0
+        for mod in self.modules:
+            prefixes = getattr(mod, 'MODULE_PREFIXES', None) or []
+            patterns = getattr(mod, 'MODULE_PATTERNS', None) or []
+            predicate = getattr(mod, 'MODULE_PREDICATE', None)
+            count += len(prefixes)
+            for prefix in prefixes:
+                node = self.trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                node.setdefault(None, []).append(mod)
+            for pattern in patterns:
+                self.patterns.append((re.compile(pattern), mod))
+            if predicate :
+                self.predicates.append((predicate, mod))
+            if getattr(mod, 'MODULE_FALLBACK', False) :
+                self.fallback.append(mod)
+            elif not (prefixes or patterns or predicate) :
+                self.every.append(mod)
+        # Any of the patterns, to skip them all at once when none matches
+        self.combined = re.compile('|'.join("(?:{0})".format(x.pattern) for x, _ in self.patterns)) if self.patterns else None
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.debug({'prefixes': count, 'patterns': len(self.patterns), 'predicates': len(self.predicates),
+            'fallback': [x.__modname__ for x in self.fallback], 'every': [x.__modname__ for x in self.every]})
+
+    def route(self, bot, tweet):
+        ''' Gives the modules the tweet is meant for, in the order they were found '''
+        text = tweet.just_text.lstrip()
+        matched = []
+        node = self.trie
+        for char in text:
+            node = node.get(char)
+            if node is None :
+                break
+            matched.extend(node.get(None, []))
+        if self.combined and self.combined.search(text) :
+            matched.extend(mod for pattern, mod in self.patterns if pattern.search(text))
+        for predicate, mod in self.predicates:
+            try:
+                if predicate(bot, tweet) :
+                    matched.append(mod)
+            except:
+                self.logger.exception("Error in the predicate of {0}!".format(mod.__modname__))
+        if not matched :
+            matched = self.fallback
+        if self.every :
+            matched = matched + self.every
+        if len(matched) <= 1 :
+            return matched
+        return sorted(dict((x.__modname__, x) for x in matched).values(), key=lambda x: self.order[x.__modname__])
+
+class ModuleLoader:
+    '''
+        Loads the modules and keeps track of which are ready. With lazy loading each module is
+        loaded on its own thread while the bot is already polling, tweets for a module that isn't
+        ready yet wait in a queue of that module only and are handled (in order) once it's ready.
+        Logs how long each module took to import and load
+    '''
+    def __init__(self, handler, lazy=False, began=None):
+        import threading
+        from time import perf_counter
+        self.lazy = lazy
+        self.began = began or perf_counter()
+        self.states = {}
+        self.lock = threading.Lock()
+        self.__handler__ = handler
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def load(self, mod, load):
+        ''' Loads a module by calling load(mod), right away or on a thread if lazy '''
+        import threading
+        from collections import deque
+        with self.lock:
+            # Loaded again (reloaded)? the tweets waiting for it keep waiting
+            pending = self.states[mod.__modname__]['pending'] if mod.__modname__ in self.states else deque()
+            state = {'ready': False, 'pending': pending, 'thread': None, 'load': 0.0, 'waited': 0}
+            self.states[mod.__modname__] = state
+        if self.lazy :
+            state['thread'] = threading.Thread(target=self.__load__, args=(mod, load, state), name="load:{0}".format(mod.__modname__), daemon=True)
+            state['thread'].start()
+        else:
+            self.__load__(mod, load, state)
+
+    def __load__(self, mod, load, state):
+        from time import perf_counter
+        began = perf_counter()
+        load(mod)
+        state['load'] = perf_counter() - began
+        # Handle whatever came in meanwhile, the module is ready only once nothing is waiting
+        while True:
+            with self.lock:
+                if len(state['pending']) == 0 :
+                    state['ready'] = True
+                    break
+                pending = list(state['pending'])
+                state['pending'].clear()
+            state['waited'] += len(pending)
+            for bot, tweet, handoff in pending:
+                with bot.tracer.resume(handoff):
+                    self.__handler__(mod, bot, tweet)
+        self.logger.info("{0} ready in {1:.2f}s (import {2:.2f}s, load {3:.2f}s), {4} tweet(s) waited for it".format(mod.__modname__,
+            perf_counter() - self.began, getattr(mod, '__importtime__', 0), state['load'], state['waited']))
+        with self.lock:
+            if all(x['ready'] for x in self.states.values()) :
+                self.logger.info("All modules ready in {0:.2f}s: {1}".format(perf_counter() - self.began,
+                    ', '.join("{0} {1:.2f}s".format(k, v['load']) for k, v in sorted(self.states.items(), key=lambda x: -x[1]['load']))))
+
+    def submit(self, mod, bot, tweet):
+        ''' Queues the tweet if the module isn't ready yet, returns False if it's ready to handle it right away '''
+        state = self.states.get(mod.__modname__)
+        if state is None or state['ready'] :
+            return False
+        with self.lock:
+            if state['ready'] :
+                return False
+            state['pending'].append((bot, tweet, bot.tracer.handoff('loading', module=mod.__modname__)))
+        return True
+
+    def pause(self, modname):
+        ''' Makes the tweets for a module wait for it, until it's loaded again '''
+        with self.lock:
+            if modname in self.states :
+                self.states[modname]['ready'] = False
+
+    def depth(self, modname):
+        ''' Gives the number of tweets waiting for a module to be ready '''
+        state = self.states.get(modname)
+        return len(state['pending']) if state else 0
+
+    def wait(self):
+        ''' Waits for the modules still loading '''
+        for state in list(self.states.values()):
+            if state['thread'] :
+                state['thread'].join()
+
+class Supervisor:
+    '''
+        Runs the bots of one or more accounts (accounts in the config, each with its own keys and
+        overrides) in this process along with the modules. The modules are loaded once, for the
+        first account, and whatever they set up on its bot (the AITalk chatbot, the calc pool..) is
+        shared with the bots of the other accounts, while each account polls on its own with its
+        own rate limit budgets and checkpoint
+    '''
+    def __init__(self, config: Config, modules, accounts=None, began=None, serve_webhook=True, api=None):
+        import asyncio, threading
+        self.config = config
+        self.modules = modules
+        self.accounts = list(accounts) if accounts else None
+        self.current = dict((x.__modname__, x) for x in modules)
+        self.busy = {}
+        self.lock = threading.Lock()
+        self.runtime = getattr(config, 'runtime', 'threads')
+        self.router = Router([x for x in modules if hasattr(x, 'onTweetReceived')])
+        self.metrics = Metrics(config)
+        self.tracer = Tracer(config)
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+        # Concurrent dispatch of the tweets to modules, if enabled (the asyncio runtime is concurrent already)
+        self.dispatcher = None
+        if self.runtime != 'asyncio' and getattr(config, 'dispatch', None) is not None and config.dispatch.get('enabled', True) :
+            self.dispatcher = ModuleDispatcher(config, self.__run_when_ready__)
+            for mod in modules:
+                if hasattr(mod, 'onTweetReceived'):
+                    self.dispatcher.register(mod)
+            for modname in self.dispatcher.lanes:
+                self.metrics.gauge('prajnah_queue_depth', lambda modname=modname: self.dispatcher.depth(modname), queue='dispatch', module=modname)
+
+        # The tweets that waited for a module are handled on its loading thread (or on the event loop, for asyncio)
+        if self.runtime == 'asyncio' :
+            self.loader = ModuleLoader(lambda mod, bot, tweet: asyncio.run_coroutine_threadsafe(self.__run_async__(mod, bot, tweet), bot.loop).result(),
+                getattr(config, 'lazy_load', False), began)
+        else:
+            self.loader = ModuleLoader(self.__run__, getattr(config, 'lazy_load', False), began)
+
+        # A bot for each account (on the API given, if any, like a mock for benchmarks)
+        self.bots = []
+        for account in ([config.derive(x) for x in accounts] if accounts else [config]):
+            if self.runtime == 'asyncio' :
+                self.bots.append(AsyncTwitterBot(account, self.__on_request_async__, api=api, metrics=self.metrics, tracer=self.tracer))
+            else:
+                self.bots.append(TwitterBot(account, self.__on_request__, api=api, metrics=self.metrics, tracer=self.tracer))
+        if len(self.bots) > 1 :
+            self.logger.info("Running accounts: {0}".format([x.username for x in self.bots]))
+
+        # Webhooks for all the accounts come in through one receiver (served elsewhere, if not serve_webhook, and fed with receive)
+        self.serve_webhook = serve_webhook
+        self.webhook = None
+        if getattr(config, 'webhook', None) is not None and config.webhook.get('enabled', True) :
+            self.webhook = WebhookReceiver(config, self.metrics)
+            for bot in self.bots:
+                self.webhook.register(bot)
+
+    @staticmethod
+    def __logger__(mod):
+        return logging.getLogger("[{0}]".format(mod.__modname__))
+
+    def __busy__(self, mod, count):
+        ''' Keeps count of the handlers of a module running, for reloading it only once they're done '''
+        with self.lock:
+            self.busy[mod.__modname__] = self.busy.get(mod.__modname__, 0) + count
+
+    def __run__(self, mod, bot: TwitterBot, tweet):
+        ''' Runs the tweet handler of a module '''
+        import asyncio
+        self.__busy__(mod, 1)
+        try:
+            with self.metrics.time('prajnah_module_seconds', module=mod.__modname__, hook='onTweetReceived'), \
+                self.tracer.span('module', module=mod.__modname__):
+                if asyncio.iscoroutinefunction(mod.onTweetReceived):
+                    asyncio.run(mod.onTweetReceived(bot, getattr(bot.config, mod.__modname__, None), self.__logger__(mod), tweet))
+                else:
+                    mod.onTweetReceived(bot, getattr(bot.config, mod.__modname__, None), self.__logger__(mod), tweet)
+        except:
+            self.metrics.inc('prajnah_module_errors_total', module=mod.__modname__, hook='onTweetReceived')
+            self.__logger__(mod).exception("Error while processing the tweet!")
+        finally:
+            self.__busy__(mod, -1)
+
+    async def __run_async__(self, mod, bot: AsyncTwitterBot, tweet):
+        ''' Runs the tweet handler of a module on the event loop, the blocking ones on the executor '''
+        import asyncio
+        if not asyncio.iscoroutinefunction(mod.onTweetReceived):
+            return await bot.run(self.__run__, mod, bot, tweet)
+        self.__busy__(mod, 1)
+        try:
+            with self.metrics.time('prajnah_module_seconds', module=mod.__modname__, hook='onTweetReceived'), \
+                self.tracer.span('module', module=mod.__modname__):
+                await mod.onTweetReceived(bot, getattr(bot.config, mod.__modname__, None), self.__logger__(mod), tweet)
+        except:
+            self.metrics.inc('prajnah_module_errors_total', module=mod.__modname__, hook='onTweetReceived')
+            self.__logger__(mod).exception("Error while processing the tweet!")
+        finally:
+            self.__busy__(mod, -1)
+
+    def __run_when_ready__(self, mod, bot: TwitterBot, tweet):
+        ''' Runs the tweet handler of a module, unless it's still loading (then the tweet waits for it) '''
+        # The dispatcher workers hold on to the module they started with, it may have been reloaded since
+        mod = self.current.get(mod.__modname__, mod)
+        if not self.loader.submit(mod, bot, tweet):
+            self.__run__(mod, bot, tweet)
+
+    def __on_request__(self, bot: TwitterBot, tweet):
+        modules = self.router.route(bot, tweet)
+        if self.dispatcher :
+            self.dispatcher.dispatch(bot, tweet, modules)
+            return
+        for mod in modules:
+            self.__run_when_ready__(mod, bot, tweet)
+
+    async def __on_request_async__(self, bot: AsyncTwitterBot, tweet):
+        import asyncio
+        await asyncio.gather(*[self.__run_async__(mod, bot, tweet) for mod in self.router.route(bot, tweet) \
+            if not self.loader.submit(mod, bot, tweet)])
+
+    def __load__(self, mod):
+        ''' Loads a module for the first bot and shares what it set up with the others '''
+        logging.getLogger('main').info("Loading: {} (v{})".format(mod.__modname__, mod.__modver__))
+        if not hasattr(mod, 'onModuleLoad'):
+            return
+        bot = self.bots[0]
+        before = dict(vars(bot))
+        try:
+            with self.metrics.time('prajnah_module_seconds', module=mod.__modname__, hook='onModuleLoad'):
+                mod.onModuleLoad(bot, getattr(self.config, mod.__modname__, None), self.__logger__(mod))
+        except:
+            self.metrics.inc('prajnah_module_errors_total', module=mod.__modname__, hook='onModuleLoad')
+            self.__logger__(mod).exception("Error while loading module!")
+        # Whatever got set up (or replaced, when reloaded)
+        changed = [k for k, v in vars(bot).items() if k not in before or before[k] is not v]
+        for other in self.bots[1:]:
+            for name in changed:
+                setattr(other, name, getattr(bot, name))
+
+    def __unload__(self, mod):
+        logging.getLogger('main').info("Unloaded: {} (v{})".format(mod.__modname__, mod.__modver__))
+        if hasattr(mod, 'onModuleUnload'):
+            try:
+                mod.onModuleUnload(self.bots[0], getattr(self.config, mod.__modname__, None), self.__logger__(mod))
+            except:
+                self.__logger__(mod).exception("Error while unloading module!")
+
+    def reload_config(self, config: Config):
+        ''' Swaps in a new config, the handlers get the new module configs from the next tweet on '''
+        key = lambda account: account.get('access_key', None)
+        accounts = getattr(config, 'accounts', None) or []
+        if not self.accounts :
+            for bot in self.bots:
+                bot.config = config
+        else:
+            # The bots run only some of the accounts (a worker's share), each one gets its own account again
+            updated = dict((key(x), x) for x in accounts)
+            for i, (bot, account) in enumerate(zip(self.bots, self.accounts)):
+                if key(account) not in updated :
+                    self.logger.warning("The account of {0} was removed, restart to apply!".format(bot.username))
+                    continue
+                self.accounts[i] = updated[key(account)]
+                bot.config = config.derive(self.accounts[i])
+        known = set(key(x) for x in getattr(self.config, 'accounts', None) or [])
+        if any(key(x) not in known for x in accounts) :
+            self.logger.warning("Accounts were added, restart to apply!")
+        self.config = config
+        self.logger.info("Config reloaded")
+
+    def reload_module(self, mod):
+        ''' Replaces a loaded module with a new version of it, the tweets for it wait meanwhile '''
+        from time import time
+        old = self.current[mod.__modname__]
+        self.loader.pause(mod.__modname__)
+        # Let the handlers running finish with the old one
+        began = time()
+        while self.busy.get(mod.__modname__, 0) > 0 and time() - began < 30 :
+            sleep(0.05)
+        self.__unload__(old)
+        self.current[mod.__modname__] = mod
+        self.modules = [mod if x is old else x for x in self.modules]
+        self.router = Router([x for x in self.modules if hasattr(x, 'onTweetReceived')])
+        self.loader.load(mod, self.__load__)
+
+    def start(self):
+        ''' Loads the modules (in the background if lazy) and starts the bots '''
+        for mod in self.modules:
+            self.metrics.gauge('prajnah_queue_depth', lambda modname=mod.__modname__: self.loader.depth(modname), queue='loading', module=mod.__modname__)
+            self.loader.load(mod, self.__load__)
+        self.metrics.start()
+        for bot in self.bots:
+            bot.start()
+        if self.webhook and self.serve_webhook :
+            self.webhook.start()
+
+    def stop(self):
+        ''' Stops the bots and unloads the modules '''
+        if self.webhook :
+            self.webhook.stop()
+        # Modules still loading finish first, along with the tweets waiting for them
+        self.loader.wait()
+        for bot in self.bots:
+            bot.stop()
+        if self.dispatcher :
+            self.dispatcher.stop()
+        for mod in self.modules:
+            self.__unload__(mod)
+        self.metrics.stop()
+
+class WorkerPool:
+    '''
+        Spreads the accounts over worker processes, each one running a Supervisor for its share of
+        the accounts (with its own copy of the modules), and keeps them running. The workers report
+        their accounts over a pipe and are told to stop through it. The webhook, if enabled, is served
+        here and its events are forwarded to the worker running the account through the pipe
+    '''
+    def __init__(self, config_path: str, mod_dir: str, workers: int, debug=False):
+        import threading
+        import multiprocessing as mp
+        self.config_path = config_path
+        self.mod_dir = mod_dir
+        self.workers = workers
+        self.debug = debug
+        self.context = mp.get_context('spawn')
+        self.procs = [None]*workers
+        self.started = [0]*workers
+        self.routes = {}
+        self.webhook = None
+        # Set by the signal handlers, so a plain flag (an Event or a lock could be held by the very thread handling the signal)
+        self.stopping = False
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __spawn__(self, shard):
+        from time import time
+        parent, child = self.context.Pipe()
+        process = self.context.Process(target=__worker__, args=(self.config_path, self.mod_dir, shard, self.workers, self.debug, child),
+            name="worker-{0}".format(shard))
+        process.start()
+        child.close()
+        self.procs[shard] = (process, parent)
+        self.started[shard] = time()
+        self.logger.info("Started worker {0} (pid {1})".format(shard, process.pid))
+
+    def __watch__(self):
+        ''' Listens to the workers and respawns the ones that die '''
+        from multiprocessing.connection import wait
+        from time import time
+        while not self.stopping :
+            with self.lock:
+                procs = list(enumerate(self.procs))
+            ready = wait([x[1] for _, x in procs] + [x[0].sentinel for _, x in procs], timeout=1)
+            for shard, (process, conn) in procs:
+                if conn in ready :
+                    try:
+                        kind, data = conn.recv()
+                        self.logger.info("Worker {0} {1}: {2}".format(shard, kind, list(data)))
+                        if kind == 'running' :
+                            with self.lock:
+                                self.routes.update((x, shard) for x in data.values())
+                        continue
+                    except EOFError:
+                        pass
+                if (conn in ready or process.sentinel in ready) and not self.stopping :
+                    process.join()
+                    self.logger.error("Worker {0} exited ({1}), restarting..".format(shard, process.exitcode))
+                    # Died right after starting? don't keep respawning it in a tight loop
+                    if time() - self.started[shard] < 30 and self.__pause__(10) :
+                        break
+                    with self.lock:
+                        conn.close()
+                        self.__spawn__(shard)
+        if self.webhook :
+            self.webhook.stop()
+        self.__shutdown__()
+
+    def __forward__(self, account_id, payload):
+        ''' Hands over a webhook event to the worker running the account it's for '''
+        with self.lock:
+            shard = self.routes.get(account_id, None)
+            if shard is None :
+                self.logger.warning("Event for an unknown account: {0}".format(account_id))
+                return
+            try:
+                self.procs[shard][1].send(('event', payload))
+            except (BrokenPipeError, OSError):
+                self.logger.warning("Worker {0} is down, its event is left for the polling".format(shard))
+
+    def __pause__(self, seconds):
+        ''' Waits a while, gives True if asked to stop meanwhile '''
+        from time import time, sleep
+        until = time() + seconds
+        while not self.stopping and time() < until :
+            sleep(0.1)
+        return self.stopping
+
+    def __shutdown__(self):
+        ''' Tells the workers to stop and waits for them '''
+        self.logger.info("Stopping workers..")
+        with self.lock:
+            for process, conn in self.procs:
+                try:
+                    conn.send('stop')
+                except (BrokenPipeError, OSError):
+                    pass
+            for process, conn in self.procs:
+                process.join()
+
+    def start(self):
+        ''' Starts the workers and watches over them until stopped '''
+        config = Config(self.config_path)
+        with self.lock:
+            for shard in range(self.workers):
+                self.__spawn__(shard)
+        if getattr(config, 'webhook', None) is not None and config.webhook.get('enabled', True) :
+            self.webhook = WebhookReceiver(config, forward=self.__forward__)
+            self.webhook.start()
+        self.__watch__()
+
+    def profile(self):
+        ''' Toggles the profiler of every worker (called by the signal handler, so without the lock) '''
+        import os, signal
+        for process, _ in list(self.procs):
+            if process.is_alive() :
+                os.kill(process.pid, signal.SIGUSR1)
+
+    def stop(self):
+        ''' Makes the watch stop the workers and return, safe to call from a signal handler '''
+        self.stopping = True
+
+class Reloader:
+    '''
+        Watches the config file and the files of the modules (their modification times) and reloads
+        what changed while the bot keeps running. A new config that reads fine replaces the old one
+        at once, a changed module is unloaded and loaded again on its own while the others go on
+    '''
+    def __init__(self, supervisor: Supervisor, config_path: str, interval=2):
+        import threading
+        self.supervisor = supervisor
+        self.config_path = config_path
+        self.interval = interval
+        self.mtimes = {}
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.__watch__, name='Reloader', daemon=True)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        for path in [config_path] + [x.__file__ for x in supervisor.modules]:
+            self.mtimes[path] = self.__mtime__(path)
+
+    @staticmethod
+    def __mtime__(path):
+        import os
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def __changed__(self, path):
+        mtime = self.__mtime__(path)
+        if mtime is None or mtime == self.mtimes.get(path, None) :
+            return False
+        self.mtimes[path] = mtime
+        return True
+
+    def check(self):
+        ''' Reloads whatever changed since the last check '''
+        if self.__changed__(self.config_path) :
+            try:
+                self.supervisor.reload_config(Config(self.config_path))
+            except ConfigParseError:
+                self.logger.error("Keeping the current config, the new one failed to read")
+        for mod in list(self.supervisor.modules):
+            if not self.__changed__(mod.__file__) :
+                continue
+            self.logger.info("Reloading {0}..".format(mod.__modname__))
+            try:
+                mod = reimport_module(mod)
+            except:
+                self.logger.exception("Keeping the current {0}, the new one failed to import".format(mod.__modname__))
+                continue
+            self.supervisor.reload_module(mod)
+
+    def __watch__(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                self.check()
+            except:
+                self.logger.exception("Failed to reload!")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+def __worker__(config_path, mod_dir, shard, workers, debug, conn):
+    ''' Runs a worker process of WorkerPool, with every workers-th account starting from shard '''
+    import signal, threading
+    # Stopping is up to the parent
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    logging.basicConfig(format='%(asctime)s %(levelname)-8s %(name)-12s - %(message)s', level=(logging.DEBUG if debug else logging.INFO))
+    config = Config(config_path)
+    if hasattr(signal, 'SIGUSR1') :
+        profiler = Profiler(config)
+        signal.signal(signal.SIGUSR1, lambda signal, frame: profiler.toggle())
+    accounts = config.accounts[shard::workers]
+    modules = find_modules(mod_dir)
+    # The parent serves the webhook, and forwards the events for these accounts here
+    supervisor = Supervisor(config, modules, accounts, serve_webhook=False)
+    reloader = None
+    if getattr(config, 'reload', None) is not None and config.reload.get('enabled', True) :
+        reloader = Reloader(supervisor, config_path, float(config.reload.get('interval', 2)))
+    supervisor.start()
+    if reloader :
+        reloader.start()
+    def receive(payload):
+        try:
+            supervisor.webhook.receive(payload)
+        except:
+            logging.getLogger('main').exception("Failed to handle the event!")
+    conn.send(('running', dict((x.username, str(x.me.id)) for x in supervisor.bots)))
+    try:
+        while True:
+            message = conn.recv()
+            if message == 'stop' :
+                break
+            kind, data = message
+            if kind == 'event' and supervisor.webhook :
+                threading.Thread(target=receive, args=(data,), daemon=True).start()
+    except EOFError:
+        pass
+    if reloader :
+        reloader.stop()
+    supervisor.stop()
+
+def find_modules(mod_dir, names=None):
+    ''' Imports all the modules (or the ones named) in the modules directory '''
     import importlib as imp
     import pkgutil as pk
+    import os, sys
+    from time import perf_counter
+
+    sys.path.append(mod_dir)
+    modules = []
+    for _, name, isPkg in pk.iter_modules([os.path.realpath(mod_dir)]):
+        if not isPkg and (names is None or name in names) :
+            began = perf_counter()
+            mod = imp.import_module(name)
+            mod.__importtime__ = perf_counter() - began
+            mod.__modname__ = getattr(mod, 'MODULE_NAME', mod.__name__[len(mod.__package__)+1:])
+            mod.__modver__ = getattr(mod, 'MODULE_VERSION', '0.1')
+            modules.append(mod)
+    return modules
+
+def reimport_module(mod):
+    ''' Imports the module again from its file, as a new module object known by the same name '''
+    import importlib.util, sys
+    from time import perf_counter
+    began = perf_counter()
+    spec = importlib.util.spec_from_file_location(mod.__name__, mod.__file__)
+    new = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(new)
+    sys.modules[mod.__name__] = new
+    new.__importtime__ = perf_counter() - began
+    new.__modname__ = mod.__modname__
+    new.__modver__ = getattr(new, 'MODULE_VERSION', '0.1')
+    return new
+
+def main():
     import os, signal, sys
     from argparse import ArgumentParser
+    from time import perf_counter
+
+    began = perf_counter()
 
     parser = ArgumentParser(description="AI chat bot for Twitter")
     parser.add_argument('-c', '--config', help="Config file (default: config.json)", dest='config', nargs=1, type=str, default=[CONFIG_FILE])
@@ -251,56 +2228,50 @@ def main():
         logging.getLogger('main').fatal(ex)
         exit(2)
 
+    accounts = getattr(config, 'accounts', None) or None
+    workers = min(max(int(getattr(config, 'account_workers', 1)), 1), len(accounts or [None]))
+
+    # Spread the accounts over worker processes, if asked to
+    if workers > 1 :
+        pool = WorkerPool(args.config[0], args.mod_dir[0], workers, args.debug)
+        signal.signal(signal.SIGTERM, lambda signal, frame: pool.stop())
+        signal.signal(signal.SIGINT, lambda signal, frame: pool.stop())
+        if hasattr(signal, 'SIGUSR1') :
+            signal.signal(signal.SIGUSR1, lambda signal, frame: pool.profile())
+        pool.start()
+        return
+
     # Find all modules 
-    sys.path.append(args.mod_dir[0])
-    modules = []
-    for _, name, isPkg in pk.iter_modules([os.path.realpath(args.mod_dir[0])]):
-        if not isPkg :
-            mod = imp.import_module(name)
-            mod.__modname__ = getattr(mod, 'MODULE_NAME', mod.__name__[len(mod.__package__)+1:])
-            mod.__modver__ = getattr(mod, 'MODULE_VERSION', '0.1')
-            modules.append(mod)
+    modules = find_modules(args.mod_dir[0])
     logging.getLogger('main').info('Found Modules: {0}'.format([x.__modname__ for x in modules]))
 
-    # Handler for bot requests
-    def onBotRequest(bot: TwitterBot, tweet):
-        for mod in modules:
-            if hasattr(mod, 'onTweetReceived'):
-                try:
-                    mod.onTweetReceived(bot, getattr(config, mod.__modname__, None), logging.getLogger("[{0}]".format(mod.__modname__)), tweet)
-                except:
-                    logging.getLogger("[{0}]".format(mod.__modname__)).exception("Error while processing the tweet!")
-
-    # Init bot
+    # Init bot(s)
     try:
-        bot = TwitterBot(config, onBotRequest)
+        supervisor = Supervisor(config, modules, accounts, began)
     except TwitterConnectionError as ex:
         logging.getLogger('main').error(ex)
         exit(4)
 
-    # Loading all the modules
-    for mod in modules:
-        logging.getLogger('main').info("Loaded: {} (v{})".format(mod.__modname__, mod.__modver__))
-        if hasattr(mod, 'onModuleLoad'):
-            try:
-                mod.onModuleLoad(bot, getattr(config, mod.__modname__, None), logging.getLogger("[{0}]".format(mod.__modname__)))
-            except:
-                logging.getLogger("[{0}]".format(mod.__modname__)).exception("Error while loading module!")
-    
+    # Watch the config and the modules for changes, if enabled
+    reloader = None
+    if getattr(config, 'reload', None) is not None and config.reload.get('enabled', True) :
+        reloader = Reloader(supervisor, args.config[0], float(config.reload.get('interval', 2)))
+
     # Handler for interrupt and exit signal
     def onExitSignal(signal, frame):
-        bot.stop()
-        for mod in modules:
-            logging.getLogger('main').info("Unloaded: {} (v{})".format(mod.__modname__, mod.__modver__))
-            if hasattr(mod, 'onModuleUnload'):
-                try:
-                    mod.onModuleUnload(bot, getattr(config, mod.__modname__, None), logging.getLogger("[{0}]".format(mod.__modname__)))
-                except:
-                    logging.getLogger("[{0}]".format(mod.__modname__)).exception("Error while unloading module!")
+        if reloader :
+            reloader.stop()
+        supervisor.stop()
 
     signal.signal(signal.SIGTERM, onExitSignal)
     signal.signal(signal.SIGINT, onExitSignal)
-    bot.start()
+    # Profiling on demand
+    if hasattr(signal, 'SIGUSR1') :
+        profiler = Profiler(config)
+        signal.signal(signal.SIGUSR1, lambda signal, frame: profiler.toggle())
+    supervisor.start()
+    if reloader :
+        reloader.start()
 
 
 if __name__ == '__main__' :
@@ -25,10 +25,423 @@ SOFTWARE.
 
 MODULE_NAME = 'aitalk'
 MODULE_VERSION = '0.1'
+# Gets the tweets no command module took
+MODULE_FALLBACK = True
+
+class VectorIndex:
+    '''
+        Index of the spaCy document vectors of all the known statement texts (but the bot's own,
+        which the search algorithms leave out too), as a normalized NumPy matrix searched with
+        batched cosine similarity (or an hnswlib graph if enabled). Saved to disk as .npy files
+        which get memory mapped on the next start, and only the statements added since are
+        vectorized again
+    '''
+    # Of the saved index, the ones saved before the bot's statements were left out get rebuilt
+    VERSION = 2
+
+    def __init__(self, chatbot, config, logger):
+        import threading
+        import numpy as np
+        self.logger = logger.getChild('VectorIndex')
+        self.storage = chatbot.storage
+        self.nlp = chatbot.storage.tagger.nlp
+        self.path = config.get('path', 'aitalk_index')
+        self.top_k = int(config.get('top_k', 10))
+        self.batch_size = int(config.get('batch_size', 256))
+        self.lock = threading.Lock()
+        self.texts, self.search_texts, self.positions = [], [], {}
+        self.matrix = None
+        self.extra = []
+        self.last_id = 0
+        self.ann = None
+        self.dirty = False
+
+        self.load()
+        if config.get('ann', False):
+            try:
+                import hnswlib
+                self.ann = hnswlib.Index(space='cosine', dim=self.matrix.shape[1])
+                self.ann.init_index(max_elements=max(len(self.texts)*2, 1024), ef_construction=200, M=16)
+                if len(self.texts) > 0 :
+                    self.ann.add_items(self.matrix, np.arange(len(self.texts)))
+                self.ann.set_ef(max(self.top_k*4, 50))
+            except ImportError:
+                self.logger.warning("hnswlib not found, using exact search")
+        self.sync()
+
+    def vectorize(self, texts):
+        ''' Gives the normalized vectors of the texts as rows of a matrix '''
+        import numpy as np
+        vectors = np.array([doc.vector for doc in self.nlp.pipe(texts, batch_size=self.batch_size)], dtype=np.float32)
+        vectors = vectors.reshape(len(texts), -1)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        norms[norms == 0] = 1
+        return vectors / norms
+
+    def load(self):
+        ''' Loads the saved index (memory mapped) if there's one '''
+        import os, json
+        import numpy as np
+        try:
+            with open(os.path.join(self.path, 'texts.json'), 'r') as jsonfile:
+                meta = json.loads(jsonfile.read())
+            matrix = np.load(os.path.join(self.path, 'vectors.npy'), mmap_mode='r')
+            # The two files are replaced one after the other, a crash in between leaves them apart
+            if meta.get('version', None) != self.VERSION or not (len(meta['texts']) == len(meta['search_texts']) == matrix.shape[0]) :
+                raise ValueError("Saved index doesn't match its texts")
+            self.matrix = matrix
+            self.texts, self.search_texts, self.last_id = meta['texts'], meta['search_texts'], meta['last_id']
+            self.positions = dict((x, i) for i, x in enumerate(self.texts))
+            self.logger.info("Loaded index of {0} statements".format(len(self.texts)))
+        except FileNotFoundError:
+            self.matrix = np.zeros((0, self.vectorize(['']).shape[1]), dtype=np.float32)
+        except (ValueError, KeyError) as err:
+            self.logger.warning("Rebuilding the index, failed to load it: {0}".format(err))
+            self.matrix = np.zeros((0, self.vectorize(['']).shape[1]), dtype=np.float32)
+
+    def save(self):
+        ''' Saves the index, replacing the older one at once '''
+        import os, json
+        import numpy as np
+        with self.lock:
+            if not self.dirty :
+                return
+            self.__merge__()
+            os.makedirs(self.path, exist_ok=True)
+            with open(os.path.join(self.path, 'vectors.tmp.npy'), 'wb') as npyfile:
+                np.save(npyfile, self.matrix)
+            with open(os.path.join(self.path, 'texts.tmp.json'), 'w') as jsonfile:
+                jsonfile.write(json.dumps({'version': self.VERSION, 'texts': self.texts, 'search_texts': self.search_texts, 'last_id': self.last_id}))
+            os.replace(os.path.join(self.path, 'vectors.tmp.npy'), os.path.join(self.path, 'vectors.npy'))
+            os.replace(os.path.join(self.path, 'texts.tmp.json'), os.path.join(self.path, 'texts.json'))
+            self.dirty = False
+        self.logger.info("Saved index of {0} statements".format(len(self.texts)))
+
+    def __merge__(self):
+        import numpy as np
+        if len(self.extra) > 0 :
+            self.matrix = np.vstack([self.matrix] + self.extra)
+            self.extra = []
+
+    def add(self, texts, search_texts=None, personas=None):
+        ''' Adds the texts not already in the index, but the bot's own '''
+        import numpy as np
+        if personas is not None :
+            keep = [not (x or '').startswith('bot:') for x in personas]
+            texts = [x for x, y in zip(texts, keep) if y]
+            search_texts = [x for x, y in zip(search_texts, keep) if y] if search_texts is not None else None
+        if search_texts is None :
+            search_texts = [self.storage.tagger.get_text_index_string(x) for x in texts]
+        new = [(x, y) for x, y in zip(texts, search_texts) if x not in self.positions]
+        new = list(dict(new).items())
+        if len(new) == 0 :
+            return
+        vectors = self.vectorize([x for x, _ in new])
+        with self.lock:
+            start = len(self.texts)
+            for text, search_text in new:
+                self.positions[text] = len(self.texts)
+                self.texts.append(text)
+                self.search_texts.append(search_text)
+            self.extra.append(vectors)
+            if sum(len(x) for x in self.extra) > 1024 :
+                self.__merge__()
+            if self.ann is not None :
+                if self.ann.get_max_elements() < len(self.texts) :
+                    self.ann.resize_index(len(self.texts)*2)
+                self.ann.add_items(vectors, np.arange(start, len(self.texts)))
+            self.dirty = True
+
+    def sync(self):
+        ''' Adds the statements stored in the database since the index was last updated '''
+        from time import time
+        began = time()
+        import sqlalchemy as sa
+        Statement = self.storage.get_model('statement')
+        session = self.storage.Session()
+        count = 0
+        try:
+            query = session.query(Statement.id, Statement.text, Statement.search_text).filter(Statement.id > self.last_id) \
+                .filter(sa.or_(Statement.persona == None, ~Statement.persona.startswith('bot:'))).order_by(Statement.id)
+            batch = []
+            for row in query.yield_per(self.batch_size):
+                batch.append(row)
+                if len(batch) >= self.batch_size :
+                    self.add([x.text for x in batch], [x.search_text for x in batch])
+                    self.last_id, count = batch[-1].id, count + len(batch)
+                    batch = []
+            if len(batch) > 0 :
+                self.add([x.text for x in batch], [x.search_text for x in batch])
+                self.last_id, count = batch[-1].id, count + len(batch)
+        finally:
+            session.close()
+        if count > 0 :
+            self.dirty = True
+        self.logger.info("Synced {0} statements in {1:.1f}s, {2} indexed".format(count, time() - began, len(self.texts)))
+
+    def search(self, text, k=None):
+        ''' Gives the k closest (text, search_text, similarity) to the text, closest first '''
+        import numpy as np
+        k = k or self.top_k
+        query = self.vectorize([text])[0]
+        with self.lock:
+            if len(self.texts) == 0 :
+                return []
+            if self.ann is not None :
+                labels, distances = self.ann.knn_query(query, k=min(k, len(self.texts)))
+                found = zip(labels[0], 1 - distances[0])
+            else:
+                scores = np.concatenate([self.matrix @ query] + [x @ query for x in self.extra])
+                top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+                found = ((i, scores[i]) for i in top)
+            return sorted(((self.texts[i], self.search_texts[i], float(score)) for i, score in found), key=lambda x: -x[2])
+
+class VectorSearch:
+    '''
+        ChatterBot search algorithm over the VectorIndex, in place of the pairwise comparisons of IndexedTextSearch
+    '''
+    name = 'vector_search'
+
+    def __init__(self, chatbot, index):
+        self.chatbot = chatbot
+        self.index = index
+
+    def search(self, input_statement, **additional_parameters):
+        Statement = self.chatbot.storage.get_object('statement')
+        # Yield in the increasing order of confidence, like the other search algorithms
+        for text, search_text, confidence in reversed(self.index.search(input_statement.text)):
+            statement = Statement(text=text, search_text=search_text)
+            statement.confidence = confidence
+            yield statement
+
+class MemoCache:
+    '''
+        Thread-safe LRU cache keeping count of its hits and misses, and of the time the misses
+        took to compute, to estimate the time saved by the hits
+    '''
+    def __init__(self, size):
+        import threading
+        from collections import OrderedDict
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.miss_time = 0, 0, 0.0
+
+    def get(self, key, compute):
+        ''' Gives the cached value of the key, or computes and caches it '''
+        from time import perf_counter
+        if self.size <= 0 :
+            return compute()
+        with self.lock:
+            if key in self.entries :
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        began = perf_counter()
+        value = compute()
+        with self.lock:
+            self.misses += 1
+            self.miss_time += perf_counter() - began
+            self.entries[key] = value
+            while len(self.entries) > self.size :
+                self.entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        ''' Gives the hit rate and the estimated time saved in seconds '''
+        with self.lock:
+            total = self.hits + self.misses
+            saved = self.hits * (self.miss_time / self.misses) if self.misses else 0.0
+            return {'size': len(self.entries), 'hit_rate': (self.hits / total) if total else 0.0, 'saved': saved}
+
+class Storage:
+    '''
+        Database layer of the chatbot, set up by aitalk.storage: the storage adapter gets a pooled
+        engine (tuned with WAL and pragmas when it's a local SQLite file), the response lookups can
+        go to a read replica, and the indexes the lookups need are created if missing
+    '''
+    def __init__(self, config, uri, logger):
+        storage = (config or {}).get('storage', {})
+        self.uri = uri
+        self.replica_uri = storage.get('replica_uri', None)
+        self.indexes = storage.get('indexes', True)
+        self.pool = {
+            'pool_size': int(storage.get('pool_size', 5)),
+            'max_overflow': int(storage.get('max_overflow', 10)),
+            'pool_timeout': float(storage.get('pool_timeout', 30)),
+            'pool_recycle': int(storage.get('pool_recycle', 1800))
+        }
+        self.sqlite = storage.get('sqlite', {})
+        self.reader = None
+        self.logger = logger.getChild('Storage')
+
+    def engine(self, uri):
+        ''' Creates a pooled engine for the database '''
+        import sqlalchemy as sa
+        from sqlalchemy.pool import QueuePool
+        if not uri.startswith('sqlite') :
+            return sa.create_engine(uri, pool_pre_ping=True, **self.pool)
+        if uri in ('sqlite://', 'sqlite:///:memory:') :
+            return sa.create_engine(uri)
+        # A file, the connections are kept open (and their page cache warm) and shared between the threads
+        busy_timeout = float(self.sqlite.get('busy_timeout', 5000))
+        engine = sa.create_engine(uri, poolclass=QueuePool, connect_args={'check_same_thread': False, 'timeout': busy_timeout/1000},
+            **dict((k, v) for k, v in self.pool.items() if k != 'pool_recycle'))
+        @sa.event.listens_for(engine, 'connect')
+        def pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            if self.sqlite.get('wal', True) :
+                cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous={0}'.format(self.sqlite.get('synchronous', 'NORMAL')))
+            cursor.execute('PRAGMA cache_size=-{0}'.format(int(float(self.sqlite.get('cache_mb', 64))*1024)))
+            cursor.execute('PRAGMA mmap_size={0}'.format(int(float(self.sqlite.get('mmap_mb', 256))*1024*1024)))
+            cursor.execute('PRAGMA temp_store=MEMORY')
+            cursor.close()
+        return engine
+
+    def attach(self, adapter, replica=True, indexes=None):
+        ''' Puts an SQLStorageAdapter on the pooled engine (and its lookups on the replica), and creates the indexes '''
+        import copy
+        from sqlalchemy.orm import sessionmaker
+        # An in-memory database lives only on the engine which created its tables, it's kept
+        if self.uri not in ('sqlite://', 'sqlite:///:memory:') :
+            adapter.engine.dispose()
+            adapter.engine = self.engine(self.uri)
+            adapter.Session = sessionmaker(bind=adapter.engine, expire_on_commit=True)
+        if replica and self.replica_uri :
+            # A copy of the adapter on the replica does the reads, the writes (and reads right after them) stay on the primary
+            self.reader = copy.copy(adapter)
+            self.reader.engine = self.engine(self.replica_uri)
+            self.reader.Session = sessionmaker(bind=self.reader.engine, expire_on_commit=True)
+            adapter.filter, adapter.count, adapter.get_random = self.reader.filter, self.reader.count, self.reader.get_random
+            self.logger.info("Looking up responses on the replica")
+        if self.indexes if indexes is None else indexes :
+            self.index(adapter)
+        return adapter
+
+    def engines(self, adapter):
+        ''' Gives the engines in use with their names, for metrics '''
+        return [(adapter.engine, MODULE_NAME)] + ([(self.reader.engine, MODULE_NAME + '_replica')] if self.reader else [])
+
+    def index(self, adapter):
+        ''' Creates the indexes of the statement lookups, unless they exist '''
+        import sqlalchemy as sa
+        from time import perf_counter
+        began = perf_counter()
+        table = adapter.get_model('statement').__table__
+        # SQLAlchemy 1.3 can't check for an index on creating it
+        existing = set(x['name'] for x in sa.inspect(adapter.engine).get_indexes(table.name))
+        def create(name, column, **kwargs):
+            if name not in existing :
+                sa.Index(name, column, **kwargs).create(adapter.engine)
+                existing.add(name)
+        # Statements are looked up by their text (learning), and the responses by the search text of what they respond to
+        create('ix_statement_text', table.c.text)
+        create('ix_statement_search_in_response_to', table.c.search_in_response_to)
+        # The search texts are matched by the words they contain, only a trigram index helps that (on PostgreSQL)
+        if adapter.engine.dialect.name == 'postgresql' :
+            try:
+                with adapter.engine.begin() as conn:
+                    conn.execute(sa.text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                create('ix_statement_search_text_trgm', table.c.search_text, postgresql_using='gin', postgresql_ops={'search_text': 'gin_trgm_ops'})
+            except sa.exc.DBAPIError:
+                self.logger.warning("Failed to create the trigram index of search_text (pg_trgm not available?), using a plain one")
+                create('ix_statement_search_text', table.c.search_text)
+        else:
+            create('ix_statement_search_text', table.c.search_text)
+        self.logger.debug("Indexes checked in {0:.2f}s".format(perf_counter() - began))
+
+class LearnWriter:
+    '''
+        Takes the learning off the reply path: learn events are queued and a background writer
+        dedupes them, checks which texts already exist with a single indexed query, and stores
+        the new statements in one bulk transaction whenever enough of them are queued or after
+        an interval
+    '''
+    def __init__(self, aitalk, config, logger):
+        import threading, queue
+        self.aitalk = aitalk
+        self.metrics = aitalk.metrics
+        self.storage = aitalk.chatbot.storage
+        self.logger = logger.getChild('LearnWriter')
+        self.batch_size = int(config.get('batch_size', 50))
+        self.interval = float(config.get('interval', 5))
+        self.events = queue.Queue()
+        self.thread = threading.Thread(target=self.__writer__, name='LearnWriter', daemon=True)
+        self.thread.start()
+        self.metrics.gauge('prajnah_queue_depth', self.events.qsize, queue='learn', module=MODULE_NAME)
+
+    def add_statement(self, text):
+        ''' Queues a text to be stored as a statement, unless it already exists '''
+        self.events.put((text, None, None))
+
+    def add_response(self, text, in_response_to, persona=None):
+        ''' Queues a text to be learnt as a response to another '''
+        self.events.put((text, in_response_to, persona))
+
+    def __writer__(self):
+        import queue
+        from time import time
+        batch, began = [], time()
+        while True:
+            try:
+                event = self.events.get(timeout=max(self.interval - (time() - began), 0.1) if batch else None)
+            except queue.Empty:
+                event = False
+            if event is not None and event is not False :
+                if not batch :
+                    began = time()
+                batch.append(event)
+            if batch and (event is None or len(batch) >= self.batch_size or time() - began >= self.interval) :
+                try:
+                    with self.metrics.time('prajnah_aitalk_seconds', op='learn_batch'):
+                        self.write(batch)
+                except:
+                    self.logger.exception("Failed to write {0} learn events!".format(len(batch)))
+                batch = []
+            if event is None :
+                self.events.task_done()
+                return
+            if event is not False :
+                self.events.task_done()
+
+    def write(self, batch):
+        ''' Stores a batch of learn events in one transaction '''
+        from time import perf_counter
+        began = perf_counter()
+        responses = list(dict.fromkeys(x for x in batch if x[1] is not None))
+        texts = set(x for x, y, _ in batch if y is None) | set(y for _, y, _ in responses)
+        texts -= set(x for x, _, _ in responses)
+        Statement = self.storage.get_model('statement')
+        session = self.storage.Session()
+        try:
+            existing = set(x.text for x in session.query(Statement.text).filter(Statement.text.in_(texts))) if texts else set()
+        finally:
+            session.close()
+        statements = [self.aitalk.gen_statement(text=x) for x in texts - existing]
+        statements += [self.aitalk.gen_statement(text=x, in_response_to=y, persona=z) for x, y, z in responses]
+        if statements :
+            self.storage.create_many(statements)
+        for _, y, _ in responses:
+            self.aitalk.responses.invalidate(self.aitalk.normalize(y))
+        if self.aitalk.index :
+            self.aitalk.index.add([x.text for x in statements], personas=[x.persona for x in statements])
+        self.logger.debug("Wrote {0} statements from {1} events in {2:.3f}s".format(len(statements), len(batch), perf_counter() - began))
+
+    def flush(self):
+        ''' Writes everything queued and stops the writer '''
+        self.events.put(None)
+        self.thread.join()
 
 class AITalk:
     def __init__(self, bot, config, logger):
         self.logger = logger.getChild('AITalk')
+        self.metrics = bot.metrics
+        self.tracer = bot.tracer
         from chatterbot import ChatBot
         from chatterbot.comparisons import SpacySimilarity
 
@@ -41,7 +454,62 @@ class AITalk:
             storage_adapter = 'chatterbot.storage.SQLStorageAdapter',
             database_uri = db_uri
             )
+        self.storage = Storage(config, db_uri, self.logger)
+        self.storage.attach(self.chatbot.storage)
+        for engine, db in self.storage.engines(self.chatbot.storage):
+            self.metrics.watch(engine, db)
+            self.tracer.watch(engine, db)
+
+        # Memoize the tagger (a spaCy pass each time) and the read-only responses
+        cache = (config or {}).get('cache', {})
+        self.cache_log_every = int(cache.get('log_every', 100))
+        self.search_texts = MemoCache(int(cache.get('size', 1024)))
+        self.responses = MemoCache(int(cache.get('size', 1024)))
+        self.lookups = 0
+        tagger = self.chatbot.storage.tagger
+        get_text_index_string = self.__traced__('aitalk:tagger', tagger.get_text_index_string)
+        tagger.get_text_index_string = lambda text: self.search_texts.get(text, lambda: get_text_index_string(text))
+
+        # Vector index for finding the closest statements, if enabled
+        self.index = None
+        if config and config.get('index', None) is not None :
+            self.index = VectorIndex(self.chatbot, config['index'], self.logger)
+            search = VectorSearch(self.chatbot, self.index)
+            self.chatbot.search_algorithms[search.name] = search
+            for adapter in self.chatbot.logic_adapters:
+                if hasattr(adapter, 'search_algorithm'):
+                    adapter.search_algorithm = search
+
+        # Each comparison is too quick to be a span of its own, they're totalled in the trace instead
+        for search in self.chatbot.search_algorithms.values():
+            if hasattr(search, 'compare_statements'):
+                search.compare_statements = self.__traced__('aitalk:compare', search.compare_statements)
+
+        # Learning happens in the background
+        self.writer = LearnWriter(self, (config or {}).get('learn', {}), self.logger)
+        if (config or {}).get('warm_up', True) :
+            self.__warm_up__()
         self.logger.debug("AI Talk Bot initalized with name: {}".format(bot.me.name))
+
+    def __traced__(self, name, method):
+        ''' Wraps a method to add its time to the totals of the trace, if tracing '''
+        if not self.tracer.enabled :
+            return method
+        def traced(*args, **kwargs):
+            with self.tracer.accumulate(name):
+                return method(*args, **kwargs)
+        return traced
+
+    def __warm_up__(self):
+        ''' Runs a response once, so that the first mention doesn't pay for the lazy parts of spaCy and the database connection '''
+        from time import perf_counter
+        began = perf_counter()
+        try:
+            self.__get_response__('Hello')
+        except:
+            self.logger.exception("Failed to warm up!")
+            return
+        self.logger.info("Warmed up in {0:.2f}s".format(perf_counter() - began))
     
     def __get_database_uri__(self, config):
         from os import environ
@@ -53,7 +521,7 @@ class AITalk:
         else:
             raise ConnectionError("Failed to get database URI! Provide it in the config or through DATABASE_URL environment variable!")
 
-    def gen_statement(self, text, in_response_to=None):
+    def gen_statement(self, text, in_response_to=None, persona=None):
         Statement = self.chatbot.storage.get_object('statement')
         statement_search_text = self.chatbot.storage.tagger.get_text_index_string(text)
         in_response_to_search_text = ''
@@ -63,22 +531,39 @@ class AITalk:
             text=text,
             search_text=statement_search_text,
             in_response_to=in_response_to,
-            search_in_response_to=in_response_to_search_text
+            search_in_response_to=in_response_to_search_text,
+            persona=persona or ''
         )
+    @staticmethod
+    def normalize(text):
+        return ' '.join(text.casefold().split())
+
+    def __log_cache__(self):
+        self.lookups += 1
+        if self.cache_log_every > 0 and self.lookups % self.cache_log_every == 0 :
+            responses, search_texts = self.responses.stats(), self.search_texts.stats()
+            self.logger.info("Cache hit rate: responses {0:.0%}, tagger {1:.0%}, saved ~{2:.1f}s".format(
+                responses['hit_rate'], search_texts['hit_rate'], responses['saved'] + search_texts['saved']))
+
     def respond(self, text, in_response_to=None, read_only=False):
-        response =  self.chatbot.get_response(text, read_only=True)
-        if not read_only :
-            if in_response_to :
-                self.learn(text, in_response_to)
-            else:
-                if len(list(self.chatbot.storage.filter(text=text))) == 0 :
-                    self.chatbot.storage.create(**self.gen_statement(text=text).serialize())
-            self.chatbot.learn_response(response)
+        self.__log_cache__()
+        if read_only :
+            return self.responses.get(self.normalize(text), lambda: self.__get_response__(text).text)
+        response =  self.__get_response__(text)
+        if in_response_to :
+            self.learn(text, in_response_to)
+        else:
+            self.writer.add_statement(text)
+        self.writer.add_response(response.text, text, response.persona)
         return response.text
+    def __get_response__(self, text):
+        with self.metrics.time('prajnah_aitalk_seconds', op='get_response'), self.tracer.span('aitalk:get_response'):
+            return self.chatbot.get_response(text, read_only=True)
+
     def learn(self, text, in_response_to):
-        if len(list(self.chatbot.storage.filter(text=in_response_to))) == 0 :
-            self.chatbot.storage.create(**self.gen_statement(text=in_response_to).serialize())
-        return self.chatbot.learn_response(self.gen_statement(text=text, in_response_to=in_response_to)).text
+        self.writer.add_statement(in_response_to)
+        self.writer.add_response(text, in_response_to)
+        return text
 
 def onModuleLoad(bot, config, logger):
     try:
@@ -87,12 +572,19 @@ def onModuleLoad(bot, config, logger):
         logger.exception("Error while initializng {}!".format(MODULE_NAME))
         bot.aitalk = None
 
+def onModuleUnload(bot, config, logger):
+    if bot.aitalk :
+        bot.aitalk.writer.flush()
+        if bot.aitalk.index :
+            bot.aitalk.index.save()
+
 def __respondable__(bot, tweet):
     return bot.aitalk != None and (tweet.in_reply_to_screen_name == bot.username or tweet.in_reply_to_status_id == None) and \
         (not tweet.just_text.strip().startswith('!'))
 
 def __tweet_context__(bot, tweet):
-    return bot.get_tweet(bot.get_tweet(tweet.in_reply_to_status_id).in_reply_to_status_id, ext=True)
+    with bot.tracer.span('aitalk:tweet_context'):
+        return bot.get_tweet(bot.get_tweet(tweet.in_reply_to_status_id).in_reply_to_status_id, ext=True)
 
 def onTweetReceived(bot, config, logger, tweet):
     if __respondable__(bot, tweet) :
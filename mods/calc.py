@@ -25,10 +25,133 @@ SOFTWARE.
 
 MODULE_NAME = 'calc'
 MODULE_VERSION = '0.1'
+MODULE_PREFIXES = ['!calc']
 
-def onModuleLoad(bot, config, logger):
+class CalcError(Exception):
+    def __init__(self, msg):
+        super().__init__(msg)
+        self.message = msg
+
+def __cap__(result, max_output):
+    ''' Gives the result as text no longer than max_output, without building huge texts '''
+    if isinstance(result, int) and result.bit_length() > max_output*4 :
+        return "Result too large (~{0} digits)".format(int(result.bit_length()*0.30103) + 1)
+    text = str(result)
+    return text if len(text) <= max_output else "{0}...".format(text[:max_output-3])
+
+def __worker__(conn, max_time, max_memory, max_output):
+    ''' Evaluates the expressions received, each with a fresh interpreter, within CPU time and memory limits '''
+    import io
     from asteval import Interpreter
-    bot.calc = Interpreter(minimal=True, max_time=3)
+    try:
+        import resource
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+    except (ImportError, ValueError):
+        resource = None
+    while True:
+        try:
+            expr = conn.recv()
+        except EOFError:
+            return
+        if resource :
+            # The CPU time limit counts for the whole process, move it past what's used already. Only the soft
+            # limit, the hard one can't be raised back, and going over the soft one ends the worker (SIGXCPU)
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            limit = int(usage.ru_utime + usage.ru_stime + max_time) + 1
+            try:
+                resource.setrlimit(resource.RLIMIT_CPU, (limit, resource.getrlimit(resource.RLIMIT_CPU)[1]))
+            except ValueError:
+                pass
+        try:
+            interpreter = Interpreter(minimal=True, max_time=max_time, writer=io.StringIO(), err_writer=io.StringIO())
+            result = interpreter(expr)
+            if interpreter.error :
+                name, msg = interpreter.error[0].get_error()
+                conn.send((False, "{0}: {1}".format(name, msg.strip().split("\n")[-1])))
+            else:
+                conn.send((True, __cap__(result, max_output)))
+        except MemoryError:
+            conn.send((False, "MemoryError: Out of memory"))
+        except Exception as err:
+            conn.send((False, "{0}: {1}".format(err.__class__.__name__, err)))
+
+class CalcPool:
+    '''
+        Pool of pre-started worker processes evaluating the expressions, so that no expression
+        holds up the bot or shares state with another. A worker running out of time is killed
+        and replaced, and the results are memoized
+    '''
+    def __init__(self, config, logger):
+        import queue, threading, multiprocessing
+        from collections import OrderedDict
+        config = config or {}
+        self.logger = logger.getChild('CalcPool')
+        self.workers = int(config.get('workers', 2))
+        self.max_time = float(config.get('max_time', 3))
+        self.max_memory = int(config.get('max_memory', 256))*1024*1024
+        self.max_output = int(config.get('max_output', 270))
+        self.cache_size = int(config.get('cache_size', 256))
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context('spawn')
+        self.idle = queue.Queue()
+        for _ in range(self.workers):
+            self.idle.put(self.__spawn__())
+
+    def __spawn__(self):
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=__worker__, args=(child_conn, self.max_time, self.max_memory, self.max_output), daemon=True)
+        process.start()
+        child_conn.close()
+        return (process, conn)
+
+    def __kill__(self, worker):
+        process, conn = worker
+        process.kill()
+        process.join()
+        conn.close()
+
+    def evaluate(self, expr: str):
+        ''' Gives the result of the expression as text, raises CalcError if it fails '''
+        with self.lock:
+            cached = self.cache.get(expr, None)
+            if cached is not None :
+                self.cache.move_to_end(expr)
+        if cached is not None :
+            ok, text = cached
+        else:
+            worker = self.idle.get()
+            try:
+                worker[1].send(expr)
+                if not worker[1].poll(self.max_time + 1) :
+                    raise TimeoutError()
+                ok, text = worker[1].recv()
+            except (TimeoutError, EOFError, OSError):
+                # Out of time (or killed by the CPU time limit), replace the worker
+                self.logger.warning("Worker killed evaluating: {0}".format(expr[:50]))
+                self.__kill__(worker)
+                worker = self.__spawn__()
+                raise CalcError("Took too long to evaluate!")
+            finally:
+                self.idle.put(worker)
+            with self.lock:
+                self.cache[expr] = (ok, text)
+                while len(self.cache) > self.cache_size :
+                    self.cache.popitem(last=False)
+        if not ok :
+            raise CalcError(text)
+        return text
+
+    def close(self):
+        for _ in range(self.workers):
+            self.__kill__(self.idle.get())
+
+def onModuleLoad(bot, config, logger):
+    bot.calc = CalcPool(config, logger)
+    bot.metrics.gauge('prajnah_calc_idle_workers', bot.calc.idle.qsize)
+
+def onModuleUnload(bot, config, logger):
+    bot.calc.close()
 
 def __respondable__(bot, tweet):
     return tweet.just_text.strip().startswith('!calc')
@@ -39,7 +162,8 @@ def onTweetReceived(bot, config, logger, tweet):
     
     res = ''
     try:
-        res = str(bot.calc(tweet.just_text.replace('!calc', '', 1).strip()))
+        with bot.metrics.time('prajnah_calc_seconds'), bot.tracer.span('calc:evaluate'):
+            res = bot.calc.evaluate(tweet.just_text.replace('!calc', '', 1).strip())
     except Exception as err:
         res = "Error: {0}".format(err)
     